@@ -1,36 +1,45 @@
-from web.WebApi import app
-from script.UserManageAPI import GiveSuperOP, DeSuperOP
-from util.YamlRead import WebHost, WebPort, SuperAdmin, RemoveSuperAdmin, CelesteNetWebRedirect
-from util.log import _log
-from util.app_data import app_data
-from waitress import serve
-from flask import request
 import logging
 
-logging.basicConfig(
-    filename='CNUTlog/web/access.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+# 头像处理进程以 spawn 方式启动, 子进程会以 __mp_main__ 的名义重新导入本文件
+# 所以 Web 应用的导入和初始化都放在 main() 里, 子进程只需要加载 PIL 和 process_avatar
+def main():
+    from web.WebApi import app
+    from script.UserManageAPI import GiveSuperOP, DeSuperOP, StartBanSweeper
+    from script.NetApiFormat import server_status
+    from util.YamlRead import (
+        WebHost, WebPort, SuperAdmin, RemoveSuperAdmin, CelesteNetWebRedirect, BanSweepInterval, StreamMaxClients, WebThreads
+    )
+    from util.log import _log
+    from util.app_data import app_data
+    from waitress import serve
+    from flask import request
 
-@app.after_request
-def log_request(response):
-    logging.info(
-        '%s - %s %s - %s',
-        request.remote_addr,
-        request.method,
-        request.path,
-        response.status_code
+    logging.basicConfig(
+        filename='CNUTlog/web/access.log',
+        level=logging.INFO,
+        format='%(asctime)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
     )
-    return response
 
-if __name__ == '__main__':
+    @app.after_request
+    def log_request(response):
+        logging.info(
+            '%s - %s %s - %s',
+            request.remote_addr,
+            request.method,
+            request.path,
+            response.status_code
+        )
+        return response
+
     _log._INFO(f"[Version]CelesteNet-UserTool v{app_data.version}")
     if RemoveSuperAdmin != None:
         DeSuperOP(RemoveSuperAdmin)
     if SuperAdmin != None:
         GiveSuperOP(SuperAdmin)
+    if BanSweepInterval > 0:
+        StartBanSweeper(BanSweepInterval)
+    server_status.Start()
     _log._INFO(f"[waitress]Web服务已开启, 请在 {WebHost}:{WebPort} 访问")
     _log._INFO(f"[waitress]前端重定向CelesteNetAPI为 {CelesteNetWebRedirect}/api")
     serve(
@@ -38,5 +47,9 @@ if __name__ == '__main__':
         host=WebHost,
         port=WebPort,
         ident=None,
-        threads=4,
-    )
\ No newline at end of file
+        # 每个推送连接会一直占用一个线程, 额外预留, 保证普通请求始终有 WebThreads 个线程可用
+        threads=WebThreads + StreamMaxClients,
+    )
+
+if __name__ == '__main__':
+    main()
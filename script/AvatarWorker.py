@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+from PIL import Image
+
+def process_avatar(src: str, outputs: dict, max_pixels: int = 4096 * 4096) -> list:
+    """
+    在子进程中执行: 按 outputs({边长: 输出路径}) 生成多个尺寸的png头像
+    先检查像素数量再解码, 防止超大图片占满内存, 结果先写临时文件再替换
+    """
+    with Image.open(src) as img:
+        width, height = img.size
+        if width * height > max_pixels:
+            raise ValueError(f"图片尺寸过大 {width}x{height}")
+        # JPEG 可以直接按缩小的尺寸解码
+        largest = max(outputs)
+        img.draft(None, (largest * 2, largest * 2))
+        img.load()
+        results = []
+        for size, dst in sorted(outputs.items()):
+            resized = img.resize((size, size), Image.Resampling.LANCZOS)
+            tmp_path = f"{dst}.tmp"
+            resized.save(tmp_path, 'PNG', optimize=True)
+            os.replace(tmp_path, dst)
+            results.append(dst)
+    return results
+
+
+class AvatarQueue:
+    """
+    头像处理队列, 图片缩放和压缩在进程池中执行, 不占用 Web 线程
+    排队数量有上限, 满了直接拒绝; 任务状态保留 JOB_TTL 秒供前端轮询
+    on_done(uid) 在处理完成后执行, 用于写入数据库
+    """
+    JOB_TTL = 600
+
+    def __init__(self, workers: int, max_pending: int, on_done):
+        self.Workers = max(1, workers)
+        self.MaxPending = max(1, max_pending)
+        self._on_done = on_done
+        self._executor = None
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._pending = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Web 服务是多线程的, 用 spawn 避免 fork 时子进程继承到被占用的锁
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.Workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    def _discard_executor(self, executor: ProcessPoolExecutor) -> None:
+        """子进程异常退出(被 OOM 杀掉/Pillow 崩溃)后进程池不能再用, 丢弃后下次提交时重建"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+    def _prune(self, now: float) -> None:
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job["state"] in ("done", "error") and now - job["updated"] > self.JOB_TTL]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _update(self, job_id: str, state: str, message: str = None) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                job["state"] = state
+                job["message"] = message
+                job["updated"] = time.time()
+
+    def Submit(self, uid: str, src: str, outputs: dict, max_pixels: int = 4096 * 4096) -> Optional[str]:
+        """提交处理任务, 队列已满时返回 None"""
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            if self._pending >= self.MaxPending:
+                return None
+            self._pending += 1
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {"uid": uid, "state": "pending", "message": None, "updated": now}
+        try:
+            # 进程池可能在空闲时就已经损坏, 换一个新的进程池再试一次
+            for retry in (True, False):
+                with self._lock:
+                    executor = self._get_executor()
+                try:
+                    future = executor.submit(process_avatar, src, outputs, max_pixels)
+                    break
+                except BrokenProcessPool:
+                    self._discard_executor(executor)
+                    if not retry:
+                        self._update(job_id, "error", "头像处理进程异常退出, 请重新上传")
+                        with self._lock:
+                            self._pending -= 1
+                        return job_id
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+                del self._jobs[job_id]
+            raise
+
+        def done(future):
+            try:
+                future.result()
+                if self._on_done(uid):
+                    self._update(job_id, "done")
+                else:
+                    self._update(job_id, "error", "写入头像失败")
+            except BrokenProcessPool:
+                self._discard_executor(executor)
+                self._update(job_id, "error", "头像处理进程异常退出, 请重新上传")
+            except Exception as e:
+                self._update(job_id, "error", str(e))
+            finally:
+                with self._lock:
+                    self._pending -= 1
+
+        future.add_done_callback(done)
+        return job_id
+
+    def Status(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def Stats(self) -> dict:
+        with self._lock:
+            return {"workers": self.Workers, "pending": self._pending, "max_pending": self.MaxPending}
+
+    def Shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,10 +1,28 @@
+import threading
+import time
 from datetime import datetime
-from util.YamlRead import CelesteNetApi
+from util.YamlRead import (
+    CelesteNetApi, ServerStatusInterval, ServerStatusMaxAge,
+    CelesteNetPoolSize, CelesteNetConnectTimeout, CelesteNetReadTimeout, CelesteNetRetries,
+    CelesteNetBreakerThreshold, CelesteNetBreakerCooldown, PlayerListTTL
+)
 from util.log import _log
+from script.NetClient import CircuitOpen, NetClient
+from util.cache import SingleFlightValue
 import requests
 
+# 所有 CelesteNet API 请求共用一个客户端, 复用连接
+client = NetClient(
+    f"http://{CelesteNetApi}",
+    pool_size=CelesteNetPoolSize,
+    connect_timeout=CelesteNetConnectTimeout,
+    read_timeout=CelesteNetReadTimeout,
+    retries=CelesteNetRetries,
+    breaker_threshold=CelesteNetBreakerThreshold,
+    breaker_cooldown=CelesteNetBreakerCooldown
+)
+
 def ServerData():
-    url = f"http://{CelesteNetApi}/status"
     result_dict = {
         "PlayerRefs": 0,
         "PlayerCounter": 0,
@@ -14,9 +32,7 @@ def ServerData():
         "TickRate": 0
     }
     try:
-        response = requests.get(url, timeout=3)
-        response.raise_for_status()
-        data = response.json()
+        data = client.Get("/status")
         result_dict["PlayerRefs"] = data["PlayerRefs"]
         result_dict["PlayerCounter"] = data["PlayerCounter"]
         result_dict["Banned"] = data["Banned"]
@@ -24,16 +40,99 @@ def ServerData():
         result_dict["TickRate"] = data["TickRate"]
         result_dict["StartupTime"] = (datetime.fromtimestamp(data["StartupTime"] / 1000)).strftime("%Y-%m-%d %H:%M:%S")
         return result_dict
+    except CircuitOpen:
+        return None
     except requests.exceptions.RequestException as e:
         _log._ERROR(f"[NetApiFormat]Error fetching API: {e}")
         return None
     
 def PlayerList(key: str) -> list:
-    url = f"http://{CelesteNetApi}/players"
     try:
-        response = requests.get(url, headers={"Cookie": f"celestenet-key={key}"}, timeout=3)
-        response.raise_for_status()
-        return response.json()
+        return client.Get("/players", key=key)
+    except CircuitOpen:
+        return None
     except requests.exceptions.RequestException as e:
         _log._ERROR(f"[NetApiFormat]Error fetching API: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def FormatPlayers(info: list) -> list:
+    """整理上游的玩家列表, 没有头像的玩家使用 Guest 头像"""
+    return [{"Name": i["Name"], "Avatar": i.get("Avatar", "/api/avatar?uid=Guest")} for i in info or []]
+
+# 在线玩家列表对所有用户都一样, 短时间内只请求一次上游, 并发请求共用同一次请求的结果
+player_list = SingleFlightValue(PlayerListTTL)
+
+def CachedPlayerList(key: str) -> list:
+    """key 只用于请求上游时的鉴权, 返回整理后的玩家列表, 失败时返回 None"""
+    def load():
+        info = PlayerList(key)
+        return None if info is None else FormatPlayers(info)
+    return player_list.get(load, wait_timeout=client.MaxRequestTime)
+
+class ServerStatusFeed:
+    """
+    后台线程每隔 interval 秒请求一次 ServerData, 结果保存为内存快照, 接口直接读取快照
+    请求失败时保留上一次成功的数据(stale), 超过 max_age 秒没有成功过才返回 None
+    第一次 Get 时自动启动后台线程
+    """
+    def __init__(self, fetch, interval: float = 5.0, max_age: float = 60.0):
+        self._fetch = fetch
+        self.Interval = max(0.5, interval)
+        self.MaxAge = max_age
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # (数据, 最后一次成功的时间戳, 最后一次请求是否失败)
+        self._snapshot = (None, None, False)
+        self.Polls = 0
+        self.Failures = 0
+        # 每次刷新成功后依次调用 listener(数据, 时间戳)
+        self.Listeners = []
+
+    def Refresh(self) -> bool:
+        """请求一次上游并更新快照, 返回是否成功"""
+        data = self._fetch()
+        self.Polls += 1
+        if data is None:
+            self.Failures += 1
+            self._snapshot = (self._snapshot[0], self._snapshot[1], True)
+            return False
+        now = time.time()
+        self._snapshot = (data, now, False)
+        for listener in self.Listeners:
+            listener(data, now)
+        return True
+
+    def _loop(self, stop: threading.Event) -> None:
+        while not stop.is_set():
+            try:
+                self.Refresh()
+            except Exception as e:
+                _log._ERROR(f"[ServerStatusFeed]x 刷新服务器状态失败: {e}")
+            stop.wait(self.Interval)
+
+    def Start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and not self._stop.is_set():
+                return
+            # 每次启动使用新的 Event, 旧线程在下一次等待时退出
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._loop, args=(self._stop,), name="ServerStatusFeed", daemon=True)
+            self._thread.start()
+
+    def Stop(self) -> None:
+        self._stop.set()
+
+    def Get(self) -> dict:
+        """返回 {"data": 数据或None, "updated": 最后一次成功的时间戳, "stale": 数据是否过期}"""
+        if self._thread is None:
+            self.Start()
+        data, updated, failed = self._snapshot
+        now = time.time()
+        if updated is None or now - updated > self.MaxAge:
+            data = None
+        stale = failed or updated is None or now - updated > self.Interval * 2
+        return {"data": data, "updated": updated, "stale": stale}
+
+
+server_status = ServerStatusFeed(ServerData, ServerStatusInterval, ServerStatusMaxAge)
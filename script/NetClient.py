@@ -0,0 +1,111 @@
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from util.log import _log
+
+class CircuitOpen(requests.exceptions.RequestException):
+    """熔断期间直接拒绝请求, 不连接上游"""
+
+
+class NetClient:
+    """
+    CelesteNet API 共用的 HTTP 客户端
+    使用同一个 requests.Session 保持长连接, 连接池大小/超时/重试次数可配置
+    连续失败 breaker_threshold 次后熔断 breaker_cooldown 秒, 期间直接抛出 CircuitOpen;
+    冷却结束后放行一个请求试探, 成功则恢复
+    """
+    def __init__(self, base_url: str, pool_size: int = 8, connect_timeout: float = 2.0, read_timeout: float = 3.0,
+                 retries: int = 1, backoff: float = 0.2, breaker_threshold: int = 5, breaker_cooldown: float = 30.0):
+        self.BaseUrl = base_url.rstrip("/")
+        self.Timeout = (connect_timeout, read_timeout)
+        # 一次 Get 连同全部重试和退避等待的大致最长耗时, 等待其他线程请求结果时用作超时
+        self.MaxRequestTime = (connect_timeout + read_timeout) * (retries + 1) + backoff * (2 ** retries - 1)
+        self.BreakerThreshold = max(1, breaker_threshold)
+        self.BreakerCooldown = breaker_cooldown
+
+        self.Session = requests.Session()
+        # 每个请求自己带 celestenet-key, 不能让上游下发的 Cookie 留在共用的 Session 里
+        self.Session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff,
+                      status_forcelist=(502, 503, 504), allowed_methods=frozenset({"GET"}), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size), max_retries=retry)
+        self.Session.mount("http://", adapter)
+        self.Session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False
+
+        self.Requests = 0
+        self.Errors = 0
+        self.ShortCircuits = 0
+        self.TotalLatency = 0.0
+        self.MaxLatency = 0.0
+
+    def _before(self) -> bool:
+        """返回本次请求是否为熔断后的试探请求"""
+        with self._lock:
+            if self._failures < self.BreakerThreshold:
+                return False
+            if time.monotonic() < self._open_until or self._probing:
+                self.ShortCircuits += 1
+                raise CircuitOpen(f"CelesteNet API 已熔断, {self._open_until - time.monotonic():.0f}秒后重试")
+            self._probing = True
+            return True
+
+    def _after(self, ok: bool, elapsed: float, probe: bool, server_up: bool = None) -> None:
+        """server_up 默认与 ok 相同; 4xx 之类上游正常但请求失败的情况传 True, 不计入熔断"""
+        with self._lock:
+            self.Requests += 1
+            self.TotalLatency += elapsed
+            self.MaxLatency = max(self.MaxLatency, elapsed)
+            if probe:
+                self._probing = False
+            if not ok:
+                self.Errors += 1
+            healthy = ok if server_up is None else server_up
+            if healthy:
+                if self._failures >= self.BreakerThreshold:
+                    _log._INFO("[NetClient]√ CelesteNet API 已恢复")
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._failures >= self.BreakerThreshold:
+                if self._failures == self.BreakerThreshold or probe:
+                    _log._WARN(f"[NetClient]x CelesteNet API 连续失败 {self._failures} 次, 熔断 {self.BreakerCooldown:g} 秒")
+                self._open_until = time.monotonic() + self.BreakerCooldown
+
+    def Get(self, path: str, key: str = None):
+        """GET 请求并解析 json, 失败时抛出 requests 的异常"""
+        probe = self._before()
+        headers = {"Cookie": f"celestenet-key={key}"} if key else None
+        started = time.monotonic()
+        try:
+            response = self.Session.get(f"{self.BaseUrl}{path}", headers=headers, timeout=self.Timeout)
+            response.raise_for_status()
+            data = response.json()
+        except requests.exceptions.HTTPError as e:
+            self._after(False, time.monotonic() - started, probe, server_up=e.response.status_code < 500)
+            raise
+        except BaseException:
+            self._after(False, time.monotonic() - started, probe)
+            raise
+        self._after(True, time.monotonic() - started, probe)
+        return data
+
+    def Stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.Requests,
+                "errors": self.Errors,
+                "short_circuits": self.ShortCircuits,
+                "avg_latency": self.TotalLatency / self.Requests if self.Requests else 0.0,
+                "max_latency": self.MaxLatency,
+                "circuit_open": self._failures >= self.BreakerThreshold,
+            }
@@ -0,0 +1,274 @@
+import io
+import hashlib
+import zlib
+from collections import Counter
+from typing import Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 流式读写时每次搬运的块大小
+BLOB_CHUNK_SIZE = 64 * 1024
+
+class BlobWriter(io.RawIOBase):
+    """
+    文件表的流式写入句柄, 由 SqliteUserData.write_file(uid, name, size) 返回
+    行在打开时按 zeroblob(size) 预先插入, write 直接增量写入 sqlite3.Blob
+    正常关闭时提交, 写入不足 size 或 with 中抛出异常时回滚
+    写入时顺带计算 sha256, 提交前调用 on_commit(conn, 十六进制摘要)
+    """
+    def __init__(self, conn, table: str, rowid: int, size: int, on_commit=None):
+        super().__init__()
+        self._conn = conn
+        self._blob = conn.blobopen(table, "value", rowid)
+        self.Size = size
+        self._pos = 0
+        self._failed = False
+        self._hash = hashlib.sha256()
+        self._on_commit = on_commit
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast("B")
+        n = len(view)
+        if self._pos + n > self.Size:
+            self._failed = True
+            raise ValueError(f"写入超出预设的文件大小 {self.Size}")
+        self._blob.write(view)
+        self._hash.update(view)
+        self._pos += n
+        return n
+
+    def tell(self) -> int:
+        return self._pos
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._failed = True
+        return super().__exit__(exc_type, exc, tb)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._blob.close()
+            if self._pos != self.Size:
+                self._failed = True
+                raise ValueError(f"写入大小 {self._pos} 与预设大小 {self.Size} 不一致")
+            if not self._failed and self._on_commit:
+                try:
+                    self._on_commit(self._conn, self._hash.hexdigest())
+                except BaseException:
+                    self._failed = True
+                    raise
+        finally:
+            if self._failed:
+                self._conn.__exit__(ValueError, None, None)
+            else:
+                self._conn.__exit__(None, None, None)
+            super().close()
+
+
+class BufferedBlobWriter(io.BytesIO):
+    """
+    不知道文件大小时使用, 先写入内存, 关闭时通过 memoryview 分块写入数据库, 不再额外复制整份数据
+    """
+    def __init__(self, save):
+        super().__init__()
+        self._save = save
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        view = self.getbuffer()
+        try:
+            self._save(view)
+        finally:
+            view.release()
+            super().close()
+
+
+class BlobReader(io.RawIOBase):
+    """
+    文件表的流式读取句柄, 由 SqliteUserData.open_file(uid, name) 返回
+    持有一个连接直到关闭, 请在同一线程内使用并及时关闭
+    """
+    def __init__(self, conn, table: str, rowid: int):
+        super().__init__()
+        self._conn = conn
+        self._blob = conn.blobopen(table, "value", rowid, readonly=True)
+        self.Size = len(self._blob)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._blob.seek(offset, whence)
+        return self._blob.tell()
+
+    def tell(self) -> int:
+        return self._blob.tell()
+
+    def readinto(self, b) -> int:
+        data = self._blob.read(len(b))
+        n = len(data)
+        memoryview(b).cast("B")[:n] = data
+        return n
+
+    def read(self, size: int = -1) -> bytes:
+        return self._blob.read(size)
+
+    def read_range(self, offset: int, length: int) -> memoryview:
+        """读取 [offset, offset+length) 区间, 返回 memoryview, 不移动读取位置"""
+        end = min(offset + length, self.Size)
+        if offset >= end:
+            return memoryview(b"")
+        return memoryview(self._blob[offset:end])
+
+    def iter_chunks(self, chunk_size: int = BLOB_CHUNK_SIZE):
+        """从当前位置开始分块读取到结尾"""
+        while True:
+            data = self._blob.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._blob.close()
+        finally:
+            self._conn.__exit__(None, None, None)
+            super().close()
+
+
+class BytesReader(io.BytesIO):
+    """内存中的读取句柄, 接口与 BlobReader 保持一致, 用于需要解压的内容"""
+    def __init__(self, data: bytes):
+        super().__init__(data)
+        self.Size = len(data)
+
+    def read_range(self, offset: int, length: int) -> memoryview:
+        return self.getbuffer()[offset:offset + length]
+
+    def iter_chunks(self, chunk_size: int = BLOB_CHUNK_SIZE):
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+
+class BlobStore:
+    """
+    内容寻址的文件存储, [usertool.blob] 以原始内容的 sha256 为主键并记录引用计数, 相同内容只存一份
+    文件表中对应行的 value 存放 TEXT 类型的 sha256 作为指针, 与 BLOB 类型的内联内容用 typeof 区分
+    非图片内容可选压缩, 优先 zstd, 没有安装 zstandard 时用 zlib, 只有压缩后更小才会采用
+    """
+    TABLE = "usertool.blob"
+    IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp")
+
+    def __init__(self, compress: bool = True):
+        self.Compress = compress
+
+    @classmethod
+    def Init(cls, conn) -> None:
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS [{cls.TABLE}] (
+                hash VARCHAR(64) PRIMARY KEY,
+                refs INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                codec VARCHAR(16) NOT NULL,
+                value BLOB
+            );
+        """)
+
+    def _encode(self, name: str, view: memoryview):
+        if not self.Compress or name.lower().endswith(self.IMAGE_SUFFIXES) or len(view) < 256:
+            return "raw", view
+        if zstandard is not None:
+            codec, payload = "zstd", zstandard.ZstdCompressor(level=10).compress(view)
+        else:
+            codec, payload = "zlib", zlib.compress(view, 6)
+        if len(payload) >= len(view):
+            return "raw", view
+        return codec, payload
+
+    @staticmethod
+    def _decode(codec: str, payload: bytes) -> bytes:
+        if codec == "zstd":
+            if zstandard is None:
+                raise RuntimeError("读取该文件需要安装 zstandard")
+            return zstandard.ZstdDecompressor().decompress(payload)
+        if codec == "zlib":
+            return zlib.decompress(payload)
+        return payload
+
+    def Put(self, conn, name: str, view: memoryview) -> str:
+        """保存内容并增加一次引用, 返回 sha256"""
+        digest = hashlib.sha256(view).hexdigest()
+        cursor = conn.execute(f"UPDATE [{self.TABLE}] SET refs = refs + 1 WHERE hash = ?", (digest,))
+        if cursor.rowcount == 0:
+            codec, payload = self._encode(name, view)
+            conn.execute(f"""
+                INSERT INTO [{self.TABLE}] (hash, refs, size, codec, value)
+                VALUES (?, 1, ?, ?, ?)
+            """, (digest, len(view), codec, payload))
+        return digest
+
+    def Release(self, conn, digests) -> None:
+        """减少引用, 引用归零的内容会被删除"""
+        counts = Counter(digest for digest in digests if digest)
+        if not counts:
+            return
+        for digest, count in counts.items():
+            conn.execute(f"UPDATE [{self.TABLE}] SET refs = refs - ? WHERE hash = ?", (count, digest))
+        conn.execute(f"DELETE FROM [{self.TABLE}] WHERE refs <= 0")
+
+    def Recount(self, conn, tables) -> int:
+        """
+        按文件表中实际存在的指针重新计算引用, 删除没有引用的内容, 返回删除的数量
+        游戏服务器直接删除文件行时不会经过 Release, 引用计数只能这样校正
+        """
+        pointers = " UNION ALL ".join(f"SELECT value FROM [{table}] WHERE typeof(value) = 'text'" for table in tables)
+        if pointers:
+            conn.execute(f"""
+                WITH counted (hash, refs) AS (SELECT value, COUNT(*) FROM ({pointers}) GROUP BY value)
+                UPDATE [{self.TABLE}] SET refs = COALESCE((SELECT refs FROM counted WHERE counted.hash = [{self.TABLE}].hash), 0)
+            """)
+        else:
+            conn.execute(f"UPDATE [{self.TABLE}] SET refs = 0")
+        return conn.execute(f"DELETE FROM [{self.TABLE}] WHERE refs <= 0").rowcount
+
+    def Read(self, conn, digest: str) -> Optional[bytes]:
+        row = conn.execute(f"SELECT codec, value FROM [{self.TABLE}] WHERE hash = ?", (digest,)).fetchone()
+        if not row:
+            return None
+        return self._decode(row[0], row[1])
+
+    def Open(self, conn, digest: str):
+        """
+        未压缩的内容返回持有 conn 的 BlobReader, 关闭时归还连接
+        压缩过的内容解压到 BytesReader, 返回 (reader, 是否持有 conn)
+        """
+        row = conn.execute(f"SELECT rowid, codec FROM [{self.TABLE}] WHERE hash = ?", (digest,)).fetchone()
+        if not row:
+            return None, False
+        if row[1] == "raw":
+            return BlobReader(conn, self.TABLE, row[0]), True
+        return BytesReader(self.Read(conn, digest)), False
+
+    def Stats(self, conn) -> dict:
+        row = conn.execute(f"""
+            SELECT COUNT(*), COALESCE(SUM(refs), 0), COALESCE(SUM(length(value)), 0), COALESCE(SUM(size * refs), 0)
+            FROM [{self.TABLE}]
+        """).fetchone()
+        return {"blobs": row[0], "refs": row[1], "stored_bytes": row[2], "logical_bytes": row[3]}
@@ -2,14 +2,28 @@ import io
 import os
 import sqlite3
 import uuid
+import hashlib
 import threading
-from typing import Optional, List, Type
+import time
+from typing import Optional, List, Type, Iterable, Iterator, Tuple
 from enum import Enum
 import msgpack
-import yaml
 from io import BytesIO
 from datetime import datetime, timedelta, timezone
 from util.log import _log
+from script.SqlitePool import ConnectionPool
+from script.SqliteBlob import BlobReader, BlobStore, BlobWriter, BufferedBlobWriter, BLOB_CHUNK_SIZE
+from util.cache import LRUCache
+from util.YamlFile import load_yaml, write_yaml
+
+_MISSING = object()
+
+# 单条 IN (...) 查询的参数上限, 低于 SQLite 默认的 999
+BULK_CHUNK_SIZE = 500
+
+def _chunks(items: List[str], size: int = BULK_CHUNK_SIZE) -> Iterator[List[str]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 class DataFormat(Enum):
     MessagePack = 0
@@ -17,8 +31,13 @@ class DataFormat(Enum):
 
 class SqliteUserData:
     Illegal = set("`´'\"^[]\\//")
+    # 缓存中没有的表最多每隔这么多秒重新查一次 sqlite_master, 游戏服务器可能在运行中建表
+    SCHEMA_RECHECK_INTERVAL = 5.0
+    # 游戏服务器会直接读取这些文件, 必须在文件表里保存原始内容, 其余文件走 BlobStore 去重
+    INLINE_FILES = {"avatar.png"}
     
-    def __init__(self, real, module, user_data_root=None, version="2.0.0.0", db_name=None):
+    def __init__(self, real, module, user_data_root=None, version="2.0.0.0", db_name=None, pool_size=8, key_cache_size=4096,
+                 data_cache_size=4096, data_cache_ttl=None, compress_files=True):
         self.GlobalLock = threading.Lock()
         self.real_module = f"{real}.{module}"
         self.module = module
@@ -28,6 +47,17 @@ class SqliteUserData:
         
         self.DBPath = os.path.join(self.UserDataRoot, self.DBName)
         self._Batch = threading.local()
+        self.Pool = ConnectionPool(self.DBPath, size=pool_size)
+        self._SchemaLock = threading.Lock()
+        self._KnownTables = None
+        self._SchemaLoadedAt = 0.0
+        # key -> uid / uid -> key, 游戏服务器也可能改写meta, 所以带TTL
+        self._KeyToUID = LRUCache(key_cache_size, ttl=300)
+        self._UIDToKey = LRUCache(key_cache_size, ttl=300)
+        # (uid, name) -> 解码后的数据, None 也会缓存
+        self._DataCache = LRUCache(data_cache_size, ttl=data_cache_ttl or None)
+        self._DataGen = 0
+        self.Blobs = BlobStore(compress=compress_files)
 
         self.Version = version
         
@@ -36,9 +66,12 @@ class SqliteUserData:
             
         if not os.path.exists(self.DBPath):
             self._initialize_database()
+        self._migrate_database()
 
         if module == "Web.User":
             self.InitWebUserTable()
+        else:
+            self.InitBanIndex()
         
     
     @property
@@ -85,6 +118,201 @@ class SqliteUserData:
             conn.commit()
         _log._INFO("[_initialize_database]√ 初始化数据库完成")
 
+    def _migrate_database(self):
+        """为旧数据库补充索引和 UserTool 自己的附加表"""
+        with self.Open() as conn:
+            # 未注册用户的 meta 行 key/keyfull 为空, 可能有很多条, 唯一约束只覆盖非空密钥
+            indexes = {row[1]: (row[2], row[4]) for row in conn.execute("PRAGMA index_list(meta)")}
+            for column in ("key", "keyfull"):
+                name = f"meta.{column}"
+                if indexes.get(name) == (1, 1):
+                    continue
+                if name in indexes:
+                    # 旧版本建立的整列唯一索引, 或者之前因重复值退回的普通索引
+                    conn.execute(f"DROP INDEX [{name}]")
+                where = f"{column} IS NOT NULL AND {column} != ''"
+                try:
+                    conn.execute(f"CREATE UNIQUE INDEX [{name}] ON meta ({column}) WHERE {where}")
+                except sqlite3.IntegrityError:
+                    _log._WARN(f"[_migrate_database]meta.{column} 存在重复值, 改为普通索引")
+                    conn.execute(f"CREATE INDEX [{name}] ON meta ({column}) WHERE {where}")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS [usertool.filemeta] (
+                    uid VARCHAR(255) NOT NULL,
+                    name VARCHAR(255) NOT NULL,
+                    iid INTEGER,
+                    hash VARCHAR(64),
+                    size INTEGER,
+                    PRIMARY KEY (uid, name)
+                );
+            """)
+            BlobStore.Init(conn)
+            conn.commit()
+
+    def _CacheKey(self, uid: str, key: str) -> None:
+        if uid and key:
+            self._KeyToUID.put(key, uid)
+            self._UIDToKey.put(uid, key)
+
+    def _ForgetKey(self, uid: str) -> None:
+        key = self._UIDToKey.pop(uid)
+        if key:
+            self._KeyToUID.pop(key)
+        self._AfterCommit(self._ForgetKey, uid)
+
+    def _InvalidateData(self, uid: str, name: Optional[str] = None) -> None:
+        """写入后使解码缓存失效, name 为空时清除该 uid 的全部条目"""
+        self._DataGen += 1
+        if name is None:
+            self._DataCache.discard_where(lambda k: k[0] == uid)
+        else:
+            self._DataCache.pop((uid, name))
+        self._AfterCommit(self._InvalidateData, uid, name)
+
+    def _AfterCommit(self, func, *args) -> None:
+        """
+        处于 Batch 中时写入要等最外层提交才落库, 期间其他线程仍会读到旧数据并写回缓存
+        所以在提交后再执行一次同样的失效
+        """
+        batch = getattr(self._Batch, 'value', None)
+        if batch is not None and batch.Active:
+            batch.Pending.append((func, args))
+
+    def DataCacheStats(self) -> dict:
+        """解码数据缓存统计"""
+        return self._DataCache.Stats()
+
+    def KeyCacheStats(self) -> dict:
+        """key/uid 缓存统计"""
+        return {"key_to_uid": self._KeyToUID.Stats(), "uid_to_key": self._UIDToKey.Stats()}
+
+    def InitBanIndex(self):
+        """
+        封禁索引表, 与 BanInfo 数据表同步, 时间为真实的 Unix 时间戳, to_ts 为 NULL 表示永久封禁
+        iid 记录对应 BanInfo 行的 iid, REPLACE 写入时 iid 会变, 对账时只需要解码 iid 变化的行
+        第一次创建时从 BanInfo 回填
+        """
+        with self.Open() as conn:
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'usertool.ban'").fetchone()
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS [usertool.ban] (
+                    uid VARCHAR(255) PRIMARY KEY,
+                    from_ts REAL NOT NULL,
+                    to_ts REAL,
+                    reason TEXT,
+                    iid INTEGER
+                );
+            """)
+            if "iid" not in {row[1] for row in conn.execute("PRAGMA table_info([usertool.ban])")}:
+                # 旧版本的索引表没有 iid, 下次对账时全部重新解码一次
+                conn.execute("ALTER TABLE [usertool.ban] ADD COLUMN iid INTEGER")
+            conn.execute("CREATE INDEX IF NOT EXISTS [usertool.ban.to_ts] ON [usertool.ban] (to_ts)")
+            conn.commit()
+        if not exists:
+            count = self.SyncBanIndex()
+            _log._INFO(f"[InitBanIndex]√ 封禁索引回填完成, 共 {count} 条")
+
+    @staticmethod
+    def _BanTimestamp(value) -> Optional[float]:
+        """BanInfo 里的时间比真实时间多存了8小时, 这里换算回真实时间戳"""
+        if value is None:
+            return None
+        if isinstance(value, datetime):
+            return value.timestamp() - 8 * 3600
+        return value.seconds + value.nanoseconds / 1e9 - 8 * 3600
+
+    @classmethod
+    def _BanIndexRow(cls, value: bytes) -> tuple:
+        """把 BanInfo 的 msgpack 内容解码为索引表的 (from_ts, to_ts, reason)"""
+        data = msgpack.unpackb(value, raw=False)
+        return cls._BanTimestamp(data.get("From")) or 0, cls._BanTimestamp(data.get("To")), data.get("Reason")
+
+    def SyncBanIndex(self) -> int:
+        """
+        按 BanInfo 数据表对账封禁索引, 用于发现游戏服务器直接写入或删除的封禁
+        只比较 uid 和 iid(走 uid 索引, 不读取内容), 只解码新增或 iid 变化的行, 返回改动的行数
+        """
+        table = self.GetDataTable("BanInfo", create=True)
+        with self.Open() as conn:
+            # uid IS NOT NULL 让 SQLite 只扫描 uid 的覆盖索引, 不读取表中的 BanInfo 内容
+            expected = dict(conn.execute(f"SELECT uid, iid FROM [{table}] WHERE uid IS NOT NULL"))
+            current = dict(conn.execute("SELECT uid, iid FROM [usertool.ban]"))
+            removed = [(uid,) for uid in current if uid not in expected]
+            changed = []
+            for chunk in _chunks([uid for uid, iid in expected.items() if current.get(uid) != iid]):
+                changed.extend((uid, *self._BanIndexRow(value), iid) for uid, iid, value in conn.execute(f"""
+                    SELECT uid, iid, value FROM [{table}] WHERE uid IN ({",".join("?" * len(chunk))})
+                """, chunk))
+            if removed or changed:
+                conn.executemany("DELETE FROM [usertool.ban] WHERE uid = ?", removed)
+                conn.executemany("""
+                    INSERT OR REPLACE INTO [usertool.ban] (uid, from_ts, to_ts, reason, iid)
+                    VALUES (?, ?, ?, ?, ?)
+                """, changed)
+                conn.commit()
+        return len(removed) + len(changed)
+
+    def GetActiveBans(self, limit: int = 50, after: Optional[str] = None) -> List[dict]:
+        """分页查询当前生效的封禁, 以 uid 为游标, 下一页传入上一页最后一个 uid"""
+        now = datetime.now(timezone.utc).timestamp()
+        with self.Open() as conn:
+            rows = conn.execute("""
+                SELECT uid, from_ts, to_ts, reason FROM [usertool.ban]
+                WHERE (to_ts IS NULL OR to_ts > ?) AND uid > ?
+                ORDER BY uid LIMIT ?
+            """, (now, after or "", limit)).fetchall()
+        return [{
+            "UID": uid,
+            "Reason": reason,
+            "StartTime": datetime.fromtimestamp(from_ts).strftime("%Y-%m-%d %H:%M:%S"),
+            "EndTime": "永久封禁" if to_ts is None else datetime.fromtimestamp(to_ts).strftime("%Y-%m-%d %H:%M:%S")
+        } for uid, from_ts, to_ts, reason in rows]
+
+    def SweepExpiredBans(self, batch_size: int = 200) -> int:
+        """
+        分批清除已经过期的封禁, 由索引表找出候选, 删除前在同一事务里重新解码 BanInfo 确认
+        游戏服务器改写过的封禁(延长/永久)不删除, 只把索引表更新为实际内容
+        """
+        table = self.GetDataTable("BanInfo", create=True)
+        now = datetime.now(timezone.utc).timestamp()
+        total = 0
+        while True:
+            with self.Open() as conn:
+                uids = [row[0] for row in conn.execute("""
+                    SELECT uid FROM [usertool.ban] WHERE to_ts IS NOT NULL AND to_ts <= ? LIMIT ?
+                """, (now, batch_size))]
+                if not uids:
+                    break
+                placeholders = ",".join("?" * len(uids))
+                rows = {uid: (iid, value) for uid, iid, value in conn.execute(f"""
+                    SELECT uid, iid, value FROM [{table}] WHERE uid IN ({placeholders})
+                """, uids)}
+                expired, changed = [], []
+                for uid in uids:
+                    if uid not in rows:
+                        continue
+                    iid, value = rows[uid]
+                    row = self._BanIndexRow(value)
+                    if row[1] is not None and row[1] <= now:
+                        expired.append(uid)
+                    else:
+                        changed.append((uid, *row, iid))
+                # BanInfo 已经不存在的和确认过期的一起从索引表删除
+                stale = [(uid,) for uid in uids if uid not in rows] + [(uid,) for uid in expired]
+                conn.executemany(f"DELETE FROM [{table}] WHERE uid = ?", [(uid,) for uid in expired])
+                conn.executemany("DELETE FROM [usertool.ban] WHERE uid = ?", stale)
+                conn.executemany("""
+                    INSERT OR REPLACE INTO [usertool.ban] (uid, from_ts, to_ts, reason, iid)
+                    VALUES (?, ?, ?, ?, ?)
+                """, changed)
+                conn.commit()
+            for uid in expired:
+                self._InvalidateData(uid, "BanInfo")
+            total += len(expired)
+            if len(uids) < batch_size:
+                break
+        return total
+
     def InitWebUserTable(self):
         _log._INFO("[InitWebUserTable]正在初始化/加载数据库")
         with self.Open(sqlite3.PARSE_DECLTYPES) as conn:
@@ -99,14 +327,29 @@ class SqliteUserData:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     );
                 """)
+            conn.execute("CREATE INDEX IF NOT EXISTS [usertool.user.email] ON [usertool.user] (email)")
             conn.commit()
         _log._INFO("[InitWebUserTable]√ 初始化/加载数据库完成")
 
     
     def Open(self, mode=sqlite3.PARSE_DECLTYPES):
-        """打开数据库连接"""
-        conn = sqlite3.connect(self.DBPath, detect_types=mode)
-        return conn
+        """从连接池借出数据库连接, 同一线程内嵌套调用会复用同一个连接, 处于 Batch 中时复用批次的连接"""
+        batch = getattr(self._Batch, 'value', None)
+        if batch is not None and batch.Active:
+            mode = batch.Open(mode).Mode
+        return self.Pool.Acquire(mode)
+
+    def _OnRollback(self) -> None:
+        """批次回滚后, 缓存里可能有未落库的内容, 全部丢弃"""
+        self._KeyToUID.clear()
+        self._UIDToKey.clear()
+        self._DataGen += 1
+        self._DataCache.clear()
+        self.ResetSchemaCache()
+
+    def PoolStats(self) -> dict:
+        """连接池命中/等待统计"""
+        return self.Pool.Stats()
     
     def GetAllTables(self) -> List[str]:
         """获取所有表名"""
@@ -115,13 +358,46 @@ class SqliteUserData:
             cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table';")
             return [row[0] for row in cursor.fetchall()]
     
+    def _LoadSchema(self) -> set:
+        """从 data/file 目录表中载入已登记且实际存在的表, 只在第一次使用时执行"""
+        tables = self._KnownTables
+        if tables is not None:
+            return tables
+        with self._SchemaLock:
+            if self._KnownTables is None:
+                with self.Open() as conn:
+                    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                    catalog = set()
+                    for table in ("data", "file"):
+                        if table in existing:
+                            catalog.update(row[0] for row in conn.execute(f"SELECT name FROM [{table}]"))
+                self._KnownTables = catalog & existing
+                self._SchemaLoadedAt = time.monotonic()
+        return self._KnownTables
+
+    def _HasTable(self, name: str) -> bool:
+        """表是否存在; 缓存未命中时按 SCHEMA_RECHECK_INTERVAL 限频重新载入, 发现外部新建的表"""
+        if name in self._LoadSchema():
+            return True
+        if time.monotonic() - self._SchemaLoadedAt < self.SCHEMA_RECHECK_INTERVAL:
+            return False
+        with self._SchemaLock:
+            if time.monotonic() - self._SchemaLoadedAt >= self.SCHEMA_RECHECK_INTERVAL:
+                self._KnownTables = None
+        return name in self._LoadSchema()
+
+    def ResetSchemaCache(self) -> None:
+        """外部修改了表结构后调用, 下次访问时重新载入"""
+        with self._SchemaLock:
+            self._KnownTables = None
+
     def GetDataTable(self, type_name, create: bool) -> str:
         """获取或创建数据表"""
         real_name = f"{self.real_module}.{type_name}"
         name = f"data.{real_name}".translate(str.maketrans('', '', ''.join(self.Illegal)))
         full_type = f"{real_name}, {self.module}, Version={self.Version}, Culture=neutral, PublicKeyToken=null"
         
-        if create:
+        if create and name not in self._LoadSchema():
             with self.Open() as conn:
                 conn.execute(f"""
                     CREATE TABLE IF NOT EXISTS [{name}] (
@@ -136,6 +412,7 @@ class SqliteUserData:
                     VALUES (?, ?, ?)
                 """, (name, real_name, full_type))
                 conn.commit()
+            self._LoadSchema().add(name)
         return name
     
     def GetFileTable(self, name: str, create: bool) -> str:
@@ -143,7 +420,7 @@ class SqliteUserData:
         real_name = name
         table_name = f"file.{real_name}".translate(str.maketrans('', '', ''.join(self.Illegal)))
         
-        if create:
+        if create and table_name not in self._LoadSchema():
             with self.Open() as conn:
                 conn.execute(f"""
                     CREATE TABLE IF NOT EXISTS [{table_name}] (
@@ -157,6 +434,7 @@ class SqliteUserData:
                     VALUES (?, ?)
                 """, (table_name, real_name))
                 conn.commit()
+            self._LoadSchema().add(table_name)
         return table_name
     
     def GetUID(self, key: str) -> str:
@@ -166,12 +444,17 @@ class SqliteUserData:
             _log._WARN(f"x {key} 无法匹配到任何uid")
             return ""
         
+        result = self._KeyToUID.get(key)
+        if result:
+            return result
         with self.Open() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT uid FROM meta WHERE key = ? LIMIT 1", (key,))
+            # 带上 key != '' 才能用到 meta.key 的部分索引
+            cursor.execute("SELECT uid FROM meta WHERE key = ? AND key != '' LIMIT 1", (key,))
             row = cursor.fetchone()
             result = row[0] if row else ""
             if result:
+                self._CacheKey(result, key)
                 _log._INFO(f"√ 匹配成功 {result}: {key}")
             return result
     
@@ -180,12 +463,91 @@ class SqliteUserData:
         if not uid:
             return ""
         
+        result = self._UIDToKey.get(uid)
+        if result:
+            return result
         with self.Open() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT key FROM meta WHERE uid = ? LIMIT 1", (uid,))
             row = cursor.fetchone()
-            return row[0] if row else ""
+            result = row[0] if row else ""
+            self._CacheKey(uid, result)
+            return result
     
+    def GetUserRows(self, indexes: Iterable[str], by_key: bool = False) -> Iterator[Tuple[str, str, Optional[str], bool]]:
+        """
+        批量查询用户的 (uid, key, email, 是否有头像), 按 uid 或 key 匹配
+        meta / [usertool.user] / 头像文件表在一条查询里 LEFT JOIN, 每块只占用一次连接
+        没有注册或没有 key 的用户不会出现在结果中
+        """
+        avatar_table = self.GetFileTable("avatar.png", create=False)
+        joins = "LEFT JOIN [usertool.user] u ON u.uid = m.uid"
+        avatar = "0"
+        if self._HasTable(avatar_table):
+            joins += f" LEFT JOIN [{avatar_table}] a ON a.uid = m.uid"
+            avatar = "a.uid IS NOT NULL"
+        column = "m.key" if by_key else "m.uid"
+
+        indexes = list(dict.fromkeys(i for i in indexes if i))
+        for chunk in _chunks(indexes):
+            placeholders = ",".join("?" * len(chunk))
+            with self.Open() as conn:
+                rows = conn.execute(f"""
+                    SELECT m.uid, m.key, u.email, {avatar} FROM meta m {joins}
+                    WHERE {column} IN ({placeholders}) AND m.key IS NOT NULL AND m.key != ''
+                """, chunk).fetchall()
+            for uid, key, user_email, has_avatar in rows:
+                self._CacheKey(uid, key)
+                yield uid, key, user_email, bool(has_avatar)
+
+    @staticmethod
+    def _PrefixRange(prefix: str) -> Tuple[str, str]:
+        """把前缀匹配换成 [prefix, upper) 区间比较, 这样可以走索引"""
+        return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    def ListUsers(self, limit: int = 50, after: int = 0, prefix: Optional[str] = None,
+                  banned: Optional[bool] = None) -> List[Tuple[int, str, bool]]:
+        """
+        按 meta.iid 游标分页列出已注册用户, 返回 [(iid, uid, 是否封禁中)], 下一页传入最后一个 iid
+        prefix 同时按 uid 和邮箱前缀匹配, 分别走 meta.uid 和 [usertool.user.email] 索引
+        banned 为 True/False 时只返回封禁中/未封禁的用户
+        """
+        now = datetime.now(timezone.utc).timestamp()
+        where = ["m.iid > ?", "m.key IS NOT NULL", "m.key != ''"]
+        params = [now, after or 0]
+        if prefix:
+            low, high = self._PrefixRange(prefix)
+            where.append("""m.uid IN (
+                SELECT uid FROM meta WHERE uid >= ? AND uid < ?
+                UNION SELECT uid FROM [usertool.user] WHERE email >= ? AND email < ?
+            )""")
+            params += [low, high, low, high]
+        if banned:
+            # 封禁中的用户很少, 从封禁索引表出发查找
+            where.append("m.uid IN (SELECT uid FROM [usertool.ban] WHERE to_ts IS NULL OR to_ts > ?)")
+            params.append(now)
+        elif banned is not None:
+            where.append("banned = 0")
+        params.append(limit)
+        with self.Open() as conn:
+            rows = conn.execute(f"""
+                SELECT m.iid, m.uid, EXISTS (
+                    SELECT 1 FROM [usertool.ban] b WHERE b.uid = m.uid AND (b.to_ts IS NULL OR b.to_ts > ?)
+                ) AS banned
+                FROM meta m WHERE {" AND ".join(where)}
+                ORDER BY m.iid LIMIT ?
+            """, params).fetchall()
+        return [(iid, uid, bool(is_banned)) for iid, uid, is_banned in rows]
+
+    def GetUidTables(self, conn=None) -> List[str]:
+        """获取所有带 uid 列的表(不含 meta)"""
+        with (conn or self.Open()) as conn:
+            tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            return [
+                table for table in tables
+                if table != "meta" and conn.execute("SELECT 1 FROM pragma_table_info(?) WHERE name = 'uid'", (table,)).fetchone()
+            ]
+
     def CheckCleanup(self, uid: str) -> None:
         """检查并清理无用的UID数据"""
         with self.Open() as conn:
@@ -196,81 +558,182 @@ class SqliteUserData:
             if not row or row[0]:
                 return
             
-            for table in self.GetAllTables():
-                if table == "meta":
-                    continue
-                
-                cursor.execute(f"SELECT iid FROM [{table}] WHERE uid = ? LIMIT 1", (uid,))
-                if cursor.fetchone():
+            tables = self.GetUidTables(conn)
+            if tables:
+                query = " UNION ALL ".join(f"SELECT 1 FROM [{table}] WHERE uid = ?" for table in tables)
+                cursor.execute(f"SELECT EXISTS ({query})", (uid,) * len(tables))
+                if cursor.fetchone()[0]:
                     return
                 
             self.Wipe(uid)
+
+    def CleanupOrphans(self, chunk_size: int = 500, progress=None) -> dict:
+        """
+        批量清理无用的UID数据, 查询次数只与表的数量有关
+        1. meta 中未注册且在其他表中没有任何数据的 uid
+        2. data/file 表和封禁索引中 meta 已经不存在的 uid
+        3. BlobStore 中已经没有文件表引用的内容(游戏服务器自己删除的文件行)
+        每 chunk_size 个 uid 一个事务, progress(已处理, 总数) 用于汇报进度
+        """
+        start = time.monotonic()
+        with self.Open() as conn:
+            tables = self.GetUidTables(conn)
+            owned = [table for table in tables if table.startswith(("data.", "file.")) or table in ("usertool.ban", "usertool.filemeta")]
+            unregistered_query = "SELECT uid FROM meta WHERE NOT registered"
+            for table in tables:
+                unregistered_query += f" EXCEPT SELECT uid FROM [{table}]"
+            unregistered = [row[0] for row in conn.execute(unregistered_query)]
+            orphans = []
+            if owned:
+                orphan_query = " UNION ".join(f"SELECT uid FROM [{table}]" for table in owned)
+                orphan_query = f"SELECT uid FROM ({orphan_query}) WHERE uid IS NOT NULL EXCEPT SELECT uid FROM meta"
+                orphans = [row[0] for row in conn.execute(orphan_query)]
+
+        def clean_unregistered(conn, chunk):
+            # 查找之后玩家可能已经在游戏中注册, 或者游戏服务器写入了数据, 删除时重新检查
+            unused = "".join(f" AND NOT EXISTS (SELECT 1 FROM [{table}] t WHERE t.uid = meta.uid)" for table in self.GetUidTables(conn))
+            conn.execute(f"DELETE FROM meta WHERE uid IN ({','.join('?' * len(chunk))}) AND NOT registered{unused}", chunk)
+
+        def clean_orphans(conn, chunk):
+            registered = {row[0] for row in conn.execute(f"SELECT uid FROM meta WHERE uid IN ({','.join('?' * len(chunk))})", chunk)}
+            chunk = [uid for uid in chunk if uid not in registered]
+            if not chunk:
+                return
+            placeholders = ",".join("?" * len(chunk))
+            self._ReleaseFileBlobs(conn, chunk)
+            for table in owned:
+                conn.execute(f"DELETE FROM [{table}] WHERE uid IN ({placeholders})", chunk)
+
+        total = len(unregistered) + len(orphans)
+        done = 0
+        for uids, clean in ((unregistered, clean_unregistered), (orphans, clean_orphans)):
+            for chunk in _chunks(uids, chunk_size):
+                with self.Open() as conn:
+                    if not conn.in_transaction:
+                        # 先拿到写锁, 重新检查和删除在同一个事务里完成
+                        conn.execute("BEGIN IMMEDIATE")
+                    clean(conn, chunk)
+                    conn.commit()
+                for uid in chunk:
+                    self._ForgetKey(uid)
+                    self._InvalidateData(uid)
+                done += len(chunk)
+                if progress:
+                    progress(done, total)
+                _log._INFO(f"[CleanupOrphans]已清理 {done}/{total}")
+
+        with self.Open() as conn:
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            blobs = self.Blobs.Recount(conn, [table for table in self.GetUidTables(conn) if table.startswith("file.")])
+            conn.commit()
+
+        elapsed = time.monotonic() - start
+        _log._INFO(f"[CleanupOrphans]√ 清理完成, 未注册 {len(unregistered)} 个, 孤立数据 {len(orphans)} 个, 无引用文件 {blobs} 个, 用时 {elapsed:.2f}s")
+        return {
+            "unregistered": len(unregistered),
+            "orphans": len(orphans),
+            "blobs": blobs,
+            "tables": len(tables),
+            "elapsed": elapsed
+        }
     
     def Wipe(self, uid: str) -> None:
         """完全删除UID的所有数据"""
         try:
             with self.Open() as conn:
+                self._ReleaseFileBlobs(conn, [uid])
                 for table in self.GetAllTables():
                     try:
                         conn.execute(f"DELETE FROM [{table}] WHERE uid = ?", (uid,))
                     except sqlite3.OperationalError:
                         continue
                 conn.commit()
+            self._ForgetKey(uid)
+            self._InvalidateData(uid)
             return True
         except Exception as e:
             _log._ERROR(f"x 用户注销失败: {e}")
             return False
     
     def Create(self, uid: str, force_new_key: bool = False) -> str:
-        """创建用户&Yaml"""
-        with self.GlobalLock:
-            key = self.GetKey(uid)
-            if key and not force_new_key:
-                return False
-            
+        """
+        创建用户&Yaml
+        密钥由 meta.key 的唯一约束保证不重复, 冲突时换一个重试, 不再持有全局锁
+        Yaml 在事务提交后写入, 写入失败时撤销 meta 记录: 本次新建的行删除, 原有的行恢复原来的密钥
+        """
+        with self.Open() as conn:
+            # 游戏服务器会写入未注册的 (uid, '', '', 0) 行, force_new_key 时也会覆盖已有的行
+            previous = conn.execute("SELECT key, keyfull, registered FROM meta WHERE uid = ?", (uid,)).fetchone()
             while True:
                 key_full = str(uuid.uuid4()).replace("-", "")
                 key = key_full[:16]
-                if not self.GetUID(key):
+                try:
+                    cursor = conn.execute("""
+                        INSERT INTO meta (uid, key, keyfull, registered)
+                        VALUES (?, ?, ?, 1)
+                        ON CONFLICT(uid) DO UPDATE
+                        SET key = excluded.key, keyfull = excluded.keyfull, registered = 1
+                        WHERE ? OR meta.key IS NULL OR meta.key = ''
+                    """, (uid, key, key_full, force_new_key))
                     break
-            
+                except sqlite3.IntegrityError:
+                    continue
+            if cursor.rowcount == 0:
+                return False
+            conn.commit()
+
+        self._ForgetKey(uid)
+        try:
             os.makedirs(f"{self.UserDataRoot}/User/{uid}", exist_ok=True)
-            with open(f"{self.UserDataRoot}/User/{uid}/BasicUserInfo.yaml", 'w') as f:
-                yaml.dump({
-                    "Name": uid,
-                    "Discrim": "",
-                    "Tags": ["user"]
-                }, f)
-            
+            write_yaml(f"{self.UserDataRoot}/User/{uid}/BasicUserInfo.yaml", {
+                "Name": uid,
+                "Discrim": "",
+                "Tags": ["user"]
+            })
+        except Exception:
             with self.Open() as conn:
-                conn.execute("""
-                    REPLACE INTO meta (uid, key, keyfull, registered)
-                    VALUES (?, ?, ?, 1)
-                """, (uid, key, key_full))
+                if previous is None:
+                    conn.execute("DELETE FROM meta WHERE uid = ? AND key = ?", (uid, key))
+                else:
+                    conn.execute("""
+                        UPDATE meta SET key = ?, keyfull = ?, registered = ? WHERE uid = ? AND key = ?
+                    """, (*previous, uid, key))
                 conn.commit()
+            raise
 
-            return key
+        self._CacheKey(uid, key)
+        return key
     
-    def RegetKey(self, uid: str) -> None:
-        """重新获取密钥"""
+    def RegetKey(self, uid: str) -> str:
+        """重新获取密钥, uid 不存在时返回空字符串"""
         with self.Open() as conn:
-            new_key_full = str(uuid.uuid4()).replace("-", "")
-            new_key = new_key_full[:16]
-            conn.execute("""
-                UPDATE meta SET keyfull = ? WHERE uid = ?
-            """, (new_key_full, uid))
-            conn.execute("""
-                UPDATE meta SET key = ? WHERE uid = ?
-            """, (new_key, uid))
+            while True:
+                new_key_full = str(uuid.uuid4()).replace("-", "")
+                new_key = new_key_full[:16]
+                try:
+                    cursor = conn.execute("""
+                        UPDATE meta SET key = ?, keyfull = ? WHERE uid = ?
+                    """, (new_key, new_key_full, uid))
+                    break
+                except sqlite3.IntegrityError:
+                    continue
+            if cursor.rowcount == 0:
+                return ""
             conn.commit()
+        self._ForgetKey(uid)
+        self._CacheKey(uid, new_key)
         return new_key
 
     def insert_data(self, uid: str, name: str, data_type: Optional[Type], stream: io.IOBase) -> None:
         """初始化用户信息"""
         stream.seek(0)
-        yaml_data = yaml.safe_load(stream)
-    
-        msgpack_data = msgpack.packb(yaml_data, use_bin_type=True)
+        yaml_data = load_yaml(stream)
+        self.insert_data_dict(uid, name, yaml_data)
+
+    def insert_data_dict(self, uid: str, name: str, data: dict) -> None:
+        """写入已经解析好的用户信息"""
+        msgpack_data = msgpack.packb(data, use_bin_type=True)
         table = self.GetDataTable(name, create=True)
 
         with self.Open() as conn:
@@ -285,16 +748,19 @@ class SqliteUserData:
             if cursor.rowcount == 0:
                 print(f"ERROR: InsertData: Failed to insert {table} for UID {uid}")
                 return
+        self._InvalidateData(uid, name)
     
     def insert_ban(self, uid: str, minutes: int = 0, days: int = 0, Reason: str = "None Reason") -> dict:
         """插入Ban信息, 会覆盖旧的Ban"""
+        now = datetime.now(timezone.utc)
         BanInfo = {
             "UID": uid,
             "Name": self.get_data(uid, "BasicUserInfo")["Name"],
             "Reason": Reason,
-            "From": datetime.now(timezone.utc) + timedelta(hours=8),
+            "From": now + timedelta(hours=8),
             "To": None
         }
+        to_ts = None
         
         # Ban To
         if minutes >= 0 and days >= 0:
@@ -302,7 +768,8 @@ class SqliteUserData:
                 if BanInfo["Reason"] == "None Reason":
                     BanInfo["Reason"] = "Ban To: Forever"
             else:
-                target_time = datetime.now(timezone.utc) + timedelta(minutes=minutes, days=days, hours=8)
+                target_time = now + timedelta(minutes=minutes, days=days, hours=8)
+                to_ts = (now + timedelta(minutes=minutes, days=days)).timestamp()
                 BanInfo["To"] = target_time
                 if BanInfo["Reason"] == "None Reason":
                     BanInfo["Reason"] = target_time.strftime("Ban To: %Y-%m-%d %H:%M:%S")
@@ -322,19 +789,34 @@ class SqliteUserData:
             if cursor.rowcount == 0:
                 print(f"ERROR: InsertData: Failed to insert {table} for UID {uid}")
                 return False
+            iid = cursor.lastrowid
+            cursor.execute("""
+                REPLACE INTO [usertool.ban] (uid, from_ts, to_ts, reason, iid)
+                VALUES (?, ?, ?, ?, ?)
+            """, (uid, now.timestamp(), to_ts, BanInfo["Reason"], iid))
+        self._InvalidateData(uid, "BanInfo")
         return BanInfo
     
     def GetBanData(self, uid: str) -> dict:
-        result_dict = {
-            "Reason": None,
-            "StartTime": None,
-            "EndTime": None
-        }
         print("查询ban")
         data = self.get_data(uid, "BanInfo")
         if data is None:
             return None
         print(data)
+        return self._FormatBan(data)
+
+    def GetBanDataMany(self, uids: Iterable[str]) -> Iterator[Tuple[str, Optional[dict]]]:
+        """批量查询封禁信息, 逐个产出 (uid, 封禁信息或None)"""
+        for uid, data in self.get_data_many(uids, "BanInfo"):
+            yield uid, None if data is None else self._FormatBan(data)
+
+    @staticmethod
+    def _FormatBan(data: dict) -> dict:
+        result_dict = {
+            "Reason": None,
+            "StartTime": None,
+            "EndTime": None
+        }
         result_dict["Reason"] = data["Reason"]
         result_dict["StartTime"] = (datetime.fromtimestamp(data["From"].seconds + data["From"].nanoseconds / 1e9) - timedelta(hours=8)).strftime("%Y-%m-%d %H:%M:%S")
         if data["To"] is None:
@@ -355,37 +837,150 @@ class SqliteUserData:
                 if not row:
                     return False
                 conn.execute(f"DELETE FROM [{table}] WHERE uid = ?", (uid,))
+                conn.execute("DELETE FROM [usertool.ban] WHERE uid = ?", (uid,))
                 conn.commit()
+            self._InvalidateData(uid, "BanInfo")
             return True
         except Exception as e:
             print(f"x 删除封禁记录时发生错误: {e}")
             return False
             
-    def write_file(self, uid, name):
+    def _reserve_file(self, conn, uid: str, table: str, size: int) -> int:
+        """按大小预先插入 zeroblob 行, 返回 rowid"""
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            REPLACE INTO [{table}] (uid, value)
+            VALUES (?, zeroblob(?))
+        """, (uid, size))
+        rowid = cursor.lastrowid
+        if not rowid:
+            raise ValueError("Failed to get rowid")
+        return rowid
+
+    def _record_file(self, conn, uid: str, name: str, rowid: int, digest: str, size: int) -> None:
+        """记录文件的 sha256, 用于 ETag, iid 用来判断文件是否被其他程序改写过"""
+        conn.execute("""
+            REPLACE INTO [usertool.filemeta] (uid, name, iid, hash, size)
+            VALUES (?, ?, ?, ?, ?)
+        """, (uid, name, rowid, digest, size))
+
+    def _store_file(self, uid: str, name: str, table: str, view: memoryview) -> None:
+        with self.Open() as conn:
+            rowid = self._reserve_file(conn, uid, table, len(view))
+            blob = conn.blobopen(table, "value", rowid)
+            try:
+                for i in range(0, len(view), BLOB_CHUNK_SIZE):
+                    blob.write(view[i:i + BLOB_CHUNK_SIZE])
+            finally:
+                blob.close()
+            self._record_file(conn, uid, name, rowid, hashlib.sha256(view).hexdigest(), len(view))
+            conn.commit()
+
+    def _store_shared_file(self, uid: str, name: str, table: str, view: memoryview) -> None:
+        """内容存入 BlobStore, 文件表中只保存 sha256 指针, 并释放旧内容的引用"""
+        with self.Open() as conn:
+            row = conn.execute(f"SELECT value FROM [{table}] WHERE uid = ? AND typeof(value) = 'text'", (uid,)).fetchone()
+            digest = self.Blobs.Put(conn, name, view)
+            cursor = conn.execute(f"REPLACE INTO [{table}] (uid, value) VALUES (?, ?)", (uid, digest))
+            if row:
+                self.Blobs.Release(conn, [row[0]])
+            self._record_file(conn, uid, name, cursor.lastrowid, digest, len(view))
+            conn.commit()
+
+    def _ReleaseFileBlobs(self, conn, uids: List[str]) -> None:
+        """删除文件表中的行之前调用, 释放这些 uid 引用的 BlobStore 内容"""
+        placeholders = ",".join("?" * len(uids))
+        digests = []
+        for table in self._LoadSchema():
+            if table.startswith("file."):
+                digests.extend(row[0] for row in conn.execute(f"""
+                    SELECT value FROM [{table}] WHERE uid IN ({placeholders}) AND typeof(value) = 'text'
+                """, uids))
+        self.Blobs.Release(conn, digests)
+
+    def BlobStoreStats(self) -> dict:
+        """BlobStore 去重/压缩统计"""
+        with self.Open() as conn:
+            return self.Blobs.Stats(conn)
+
+    def GetFileHash(self, uid: str, name: str) -> Optional[str]:
         """
-        BytesIO 流 sqlite接口
+        获取文件内容的 sha256, 不读取文件内容
+        记录缺失或文件已被其他程序改写(iid变化)时才读取一次并补记录, 文件不存在返回None
         """
-        buffer = BytesIO()
+        table = self.GetFileTable(name, create=False)
+        if not self._HasTable(table):
+            return None
+        with self.Open() as conn:
+            row = conn.execute(f"""
+                SELECT f.iid, m.iid, m.hash, CASE WHEN typeof(f.value) = 'text' THEN f.value END FROM [{table}] f
+                LEFT JOIN [usertool.filemeta] m ON m.uid = f.uid AND m.name = ?
+                WHERE f.uid = ?
+            """, (name, uid)).fetchone()
+            if not row:
+                return None
+            rowid, meta_rowid, digest, pointer = row
+            if pointer:
+                return pointer
+            if rowid == meta_rowid and digest:
+                return digest
+            value = conn.execute(f"SELECT value FROM [{table}] WHERE iid = ?", (rowid,)).fetchone()[0]
+            digest = hashlib.sha256(value).hexdigest()
+            self._record_file(conn, uid, name, rowid, digest, len(value))
+            conn.commit()
+            return digest
 
-        def save_to_db():
-            buffer.seek(0)
-            table = self.GetFileTable(name, create=True)
-            with self.Open() as conn:
-                cursor = conn.cursor()
-                cursor.execute(f"""
-                    REPLACE INTO '{table}' (uid, value)
-                    VALUES (?, zeroblob(?))
-                """, (uid, len(buffer.getvalue())))
-                rowid = cursor.lastrowid
-                if not rowid:
-                    raise ValueError("Failed to get rowid")
-                blob = conn.blobopen(table, "value", rowid)
-                blob.write(buffer.getvalue())
-                blob.close()
-                conn.commit()
+    def write_file(self, uid, name, size: Optional[int] = None):
+        """
+        文件写入流 sqlite接口
+        INLINE_FILES 中的文件:
+            已知 size 时返回 BlobWriter, 数据直接分块写入数据库, 必须恰好写满 size 字节
+            不知道 size 时返回 BytesIO 缓冲, close 时一次性写入
+        其余文件先缓冲, close 时按内容哈希写入 BlobStore
+        """
+        table = self.GetFileTable(name, create=True)
+        if name not in self.INLINE_FILES:
+            return BufferedBlobWriter(lambda view: self._store_shared_file(uid, name, table, view))
+        if size is None:
+            return BufferedBlobWriter(lambda view: self._store_file(uid, name, table, view))
+        conn = self.Open()
+        try:
+            rowid = self._reserve_file(conn, uid, table, size)
+            return BlobWriter(conn, table, rowid, size,
+                              on_commit=lambda conn, digest: self._record_file(conn, uid, name, rowid, digest, size))
+        except BaseException as e:
+            conn.__exit__(type(e), e, e.__traceback__)
+            raise
 
-        buffer.close = lambda: (save_to_db(), buffer.__class__.close(buffer))
-        return buffer
+    def open_file(self, uid, name):
+        """打开文件的流式读取句柄(BlobReader/BytesReader), 支持分块读取和区间读取, 不存在时返回None"""
+        table = self.GetFileTable(name, create=False)
+        if not self._HasTable(table):
+            return None
+        conn = self.Open()
+        try:
+            row = conn.execute(f"""
+                SELECT iid, CASE WHEN typeof(value) = 'text' THEN value END FROM [{table}] WHERE uid = ?
+            """, (uid,)).fetchone()
+            if row and row[1]:
+                reader, owns_conn = self.Blobs.Open(conn, row[1])
+                if owns_conn:
+                    return reader
+                conn.__exit__(None, None, None)
+                return reader
+            if row:
+                return BlobReader(conn, table, row[0])
+        except BaseException as e:
+            conn.__exit__(type(e), e, e.__traceback__)
+            raise
+        conn.__exit__(None, None, None)
+        return None
+
+    def _resolve_file(self, conn, value) -> Optional[bytes]:
+        """文件表中 TEXT 类型的 value 是 BlobStore 指针"""
+        if isinstance(value, str):
+            return self.Blobs.Read(conn, value)
+        return value
 
     def read_file(self, uid, name):
         """读取文件数据，返回 BytesIO 流"""
@@ -393,15 +988,68 @@ class SqliteUserData:
         with self.Open() as conn:
             cursor = conn.cursor()
             cursor.execute(f"""
-                SELECT value FROM {table} WHERE uid = ?
+                SELECT value FROM [{table}] WHERE uid = ?
             """, (uid,))
             row = cursor.fetchone()
             if not row:
                 return None
-            return BytesIO(row[0])
+            value = self._resolve_file(conn, row[0])
+            return None if value is None else BytesIO(value)
         
+    def read_file_many(self, uids: Iterable[str], name: str) -> Iterator[Tuple[str, BytesIO]]:
+        """批量读取文件, 分块 IN 查询, 只产出存在文件的 (uid, BytesIO)"""
+        table = self.GetFileTable(name, create=False)
+        if not self._HasTable(table):
+            return
+        uids = list(dict.fromkeys(uids))
+        for chunk in _chunks(uids):
+            placeholders = ",".join("?" * len(chunk))
+            with self.Open() as conn:
+                rows = conn.execute(f"""
+                    SELECT uid, value FROM [{table}] WHERE uid IN ({placeholders})
+                """, chunk).fetchall()
+                rows = [(uid, self._resolve_file(conn, value)) for uid, value in rows]
+            for uid, value in rows:
+                if value is not None:
+                    yield uid, BytesIO(value)
+
+    def get_data_many(self, uids: Iterable[str], name: str) -> Iterator[Tuple[str, Optional[dict]]]:
+        """
+        批量读取数据, 逐个产出 (uid, 数据或None)
+        命中缓存的直接返回, 其余按块用 IN 查询, 每块只占用一次连接
+        """
+        uids = list(dict.fromkeys(uids))
+        missing = []
+        for uid in uids:
+            cached = self._DataCache.get((uid, name), _MISSING)
+            if cached is _MISSING:
+                missing.append(uid)
+            else:
+                yield uid, cached
+        if not missing:
+            return
+
+        table = self.GetDataTable(name, create=True)
+        for chunk in _chunks(missing):
+            gen = self._DataGen
+            placeholders = ",".join("?" * len(chunk))
+            with self.Open() as conn:
+                rows = dict(conn.execute(f"""
+                    SELECT uid, value FROM [{table}] WHERE uid IN ({placeholders})
+                """, chunk).fetchall())
+            for uid in chunk:
+                value = rows.get(uid)
+                result = None if value is None else msgpack.unpackb(value, raw=False)
+                if gen == self._DataGen:
+                    self._DataCache.put((uid, name), result)
+                yield uid, result
+
     def get_data(self, uid: str, name: str) -> Optional[dict]:
-        """根据 UID 和表名读取数据"""
+        """根据 UID 和表名读取数据, 优先读缓存, 返回的对象是共享的, 不要修改"""
+        cached = self._DataCache.get((uid, name), _MISSING)
+        if cached is not _MISSING:
+            return cached
+        gen = self._DataGen
         table = self.GetDataTable(name, create=True)
         
         with self.Open() as conn:
@@ -415,14 +1063,25 @@ class SqliteUserData:
             )
             row = cursor.fetchone()
             
-            if not row:
-                return None
-            
-            msgpack_data = row[0]
-            return msgpack.unpackb(msgpack_data, raw=False)
+            result = None
+            if row:
+                msgpack_data = row[0]
+                result = msgpack.unpackb(msgpack_data, raw=False)
+            # 读取期间发生过写入则不回填, 避免缓存旧数据
+            if gen == self._DataGen:
+                self._DataCache.put((uid, name), result)
+            return result
 
 
 class BatchContext:
+    """
+    批量事务上下文, 用法:
+        with sql.Batch:
+            sql.insert_ban(...)
+            sql.RegetKey(...)
+    期间当前线程的所有 Open() 共用同一个连接和事务, 内部的 commit 会推迟到最外层退出时统一提交
+    可以嵌套(Count计数), 有异常抛出 with 时整个批次回滚
+    """
     def __init__(self, user_data: SqliteUserData):
         self.UserData = user_data
         self.Mode = None
@@ -430,6 +1089,26 @@ class BatchContext:
         self.Command = None
         self.Transaction = None
         self.Count = 0
+        self.Failed = False
+        # 提交后需要再执行一次的缓存失效
+        self.Pending = []
+
+    def __enter__(self):
+        self.Count += 1
+        if self.Count == 1:
+            self.Failed = False
+            self.Open(sqlite3.PARSE_DECLTYPES)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.Failed = True
+        self.Dispose()
+        return False
+
+    @property
+    def Active(self) -> bool:
+        return self.Count > 0
     
     def Open(self, mode):
         if self.Connection and self.Command and (not self.Mode or self.Mode <= mode):
@@ -444,7 +1123,7 @@ class BatchContext:
             self.Connection = None
         
         self.Mode = mode
-        self.Connection = self.UserData.Open(mode)
+        self.Connection = self.UserData.Pool.Acquire(mode)
         self.Command = self.Connection.cursor()
         
         if mode <= sqlite3.PARSE_DECLTYPES:
@@ -455,12 +1134,22 @@ class BatchContext:
     def Dispose(self):
         self.Count -= 1
         if self.Count <= 0:
+            self.Count = 0
+            pending, self.Pending = self.Pending, []
             if self.Transaction:
-                self.Transaction.commit()
+                if self.Failed:
+                    self.Transaction.rollback()
+                    self.UserData._OnRollback()
+                    pending = []
+                else:
+                    self.Transaction.commit()
                 self.Transaction = None
+            for func, args in dict.fromkeys(pending):
+                func(*args)
             if self.Command:
                 self.Command.close()
                 self.Command = None
             if self.Connection:
                 self.Connection.close()
                 self.Connection = None
+            self.Mode = None
@@ -0,0 +1,185 @@
+import sqlite3
+import threading
+import time
+from util.log import _log
+
+class PooledConnection:
+    """
+    连接池借出的连接句柄
+    兼容 `with sql.Open() as conn:` 写法, 其余属性全部转发给 sqlite3.Connection
+    同一线程内嵌套 Open 拿到的是同一个句柄, 只有最外层退出或 commit 时才真正提交, 退出时归还
+    """
+    def __init__(self, pool, raw: sqlite3.Connection, mode, overflow: bool = False):
+        self._pool = pool
+        self.Raw = raw
+        self.Mode = mode
+        self.Overflow = overflow
+        self.Depth = 0
+
+    def __getattr__(self, name):
+        return getattr(self.Raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.Depth <= 1:
+            if exc_type is None:
+                self.Raw.commit()
+            else:
+                self.Raw.rollback()
+        self.close()
+        return False
+
+    def commit(self):
+        """嵌套使用时由最外层负责提交, 这里什么都不做"""
+        if self.Depth <= 1:
+            self.Raw.commit()
+
+    def close(self):
+        """归还连接, 不会真正关闭"""
+        self._pool.Release(self)
+
+
+class ConnectionPool:
+    """SQLite 连接池, 同一线程内可重入, 空闲连接在线程之间复用"""
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=5000",
+        "PRAGMA cache_size=-8192",
+        "PRAGMA mmap_size=67108864",
+    )
+
+    def __init__(self, path: str, size: int = 8, timeout: float = 5.0):
+        self.Path = path
+        self.Size = max(1, size)
+        self.Timeout = timeout
+        self._idle = []
+        self._created = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+        self.Hits = 0
+        self.Misses = 0
+        self.Reentrant = 0
+        self.Overflows = 0
+        self.Waits = 0
+        self.WaitTime = 0.0
+        self.MaxWait = 0.0
+
+    def _connect(self, mode) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.Path, detect_types=mode, check_same_thread=False)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _held(self) -> dict:
+        if not hasattr(self._local, 'held'):
+            self._local.held = {}
+        return self._local.held
+
+    def Acquire(self, mode=sqlite3.PARSE_DECLTYPES) -> PooledConnection:
+        """借出一个连接, 池满时最多等待 Timeout 秒, 超时后临时新建连接"""
+        held = self._held()
+        handle = held.get(mode)
+        if handle is not None:
+            handle.Depth += 1
+            with self._cond:
+                self.Reentrant += 1
+            return handle
+
+        raw = None
+        overflow = False
+        waited = None
+        with self._cond:
+            deadline = None
+            while True:
+                for i in range(len(self._idle) - 1, -1, -1):
+                    if self._idle[i][0] == mode:
+                        raw = self._idle.pop(i)[1]
+                        self.Hits += 1
+                        break
+                if raw is not None:
+                    break
+                if self._idle and self._created >= self.Size:
+                    # 池满但空闲连接的模式不同, 关掉一个腾出位置
+                    self._idle.pop(0)[1].close()
+                    self._created -= 1
+                if self._created < self.Size:
+                    self._created += 1
+                    self.Misses += 1
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + self.Timeout
+                    waited = time.monotonic()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.Overflows += 1
+                    overflow = True
+                    break
+                self._cond.wait(remaining)
+            if waited is not None:
+                elapsed = time.monotonic() - waited
+                self.Waits += 1
+                self.WaitTime += elapsed
+                self.MaxWait = max(self.MaxWait, elapsed)
+
+        if raw is None:
+            try:
+                raw = self._connect(mode)
+            except Exception:
+                if not overflow:
+                    with self._cond:
+                        self._created -= 1
+                        self._cond.notify()
+                raise
+            if overflow:
+                _log._WARN(f"[ConnectionPool]连接池已满({self.Size}), 临时新建连接")
+
+        handle = PooledConnection(self, raw, mode, overflow)
+        handle.Depth = 1
+        held[mode] = handle
+        return handle
+
+    def Release(self, handle: PooledConnection) -> None:
+        handle.Depth -= 1
+        if handle.Depth > 0:
+            return
+        held = self._held()
+        if held.get(handle.Mode) is handle:
+            del held[handle.Mode]
+        raw = handle.Raw
+        if raw.in_transaction:
+            raw.rollback()
+        if handle.Overflow:
+            raw.close()
+            return
+        with self._cond:
+            self._idle.append((handle.Mode, raw))
+            self._cond.notify()
+
+    def Stats(self) -> dict:
+        with self._cond:
+            requests = self.Hits + self.Misses + self.Reentrant
+            return {
+                "size": self.Size,
+                "created": self._created,
+                "idle": len(self._idle),
+                "hits": self.Hits,
+                "misses": self.Misses,
+                "reentrant": self.Reentrant,
+                "overflows": self.Overflows,
+                "hit_ratio": (self.Hits + self.Reentrant) / requests if requests else 0.0,
+                "waits": self.Waits,
+                "wait_time": self.WaitTime,
+                "max_wait": self.MaxWait,
+            }
+
+    def CloseAll(self) -> None:
+        """关闭所有空闲连接"""
+        with self._cond:
+            for _, raw in self._idle:
+                raw.close()
+            self._created -= len(self._idle)
+            self._idle.clear()
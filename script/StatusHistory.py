@@ -0,0 +1,159 @@
+import re
+import threading
+import time
+from array import array
+from typing import Iterator, Optional, Tuple
+
+from util.log import _log
+
+class RingBuffer:
+    """
+    定长环形缓冲区, 每行 width 个浮点数, 全部存放在一个 array('d') 中
+    写满后覆盖最旧的行, 不会再分配内存
+    """
+    def __init__(self, capacity: int, width: int):
+        self.Capacity = max(1, capacity)
+        self.Width = width
+        self._data = array('d', bytes(8 * self.Capacity * width))
+        self._head = 0
+        self._count = 0
+
+    def Append(self, *values: float) -> None:
+        start = self._head * self.Width
+        self._data[start:start + self.Width] = array('d', values)
+        self._head = (self._head + 1) % self.Capacity
+        self._count = min(self._count + 1, self.Capacity)
+
+    def Rows(self) -> Iterator[Tuple[float, ...]]:
+        """从旧到新依次产出每一行"""
+        first = (self._head - self._count) % self.Capacity
+        for i in range(self._count):
+            start = (first + i) % self.Capacity * self.Width
+            yield tuple(self._data[start:start + self.Width])
+
+    def __len__(self) -> int:
+        return self._count
+
+
+class StatusHistory:
+    """
+    服务器状态历史, 每次成功获取状态时记录 (时间, 在线人数, Tick)
+    最近的原始数据保存在 RingBuffer 中; 每隔 flush_interval 秒把已经结束的分钟汇总写入 [usertool.status.1m],
+    再把已经结束的小时从分钟表汇总写入 [usertool.status.1h]
+    分钟数据保留 MINUTE_RETENTION 秒, 小时数据保留 HOUR_RETENTION 秒
+    """
+    FIELDS = ("PlayerRefs", "TickRate")
+    MINUTE_TABLE = "usertool.status.1m"
+    HOUR_TABLE = "usertool.status.1h"
+    MINUTE_RETENTION = 7 * 86400
+    HOUR_RETENTION = 365 * 86400
+    # 查询范围不超过环形缓冲区时返回原始数据, 不超过 MINUTE_RANGE 时返回分钟数据, 否则返回小时数据
+    MINUTE_RANGE = 2 * 86400
+    RANGE_UNITS = {"m": 60, "h": 3600, "d": 86400}
+
+    def __init__(self, open_conn, capacity: int = 720, flush_interval: float = 60.0):
+        self._open = open_conn
+        self.Buffer = RingBuffer(capacity, 1 + len(self.FIELDS))
+        self.FlushInterval = flush_interval
+        self._lock = threading.Lock()
+        self._next_flush = time.time() + flush_interval
+        with self._open() as conn:
+            for table in (self.MINUTE_TABLE, self.HOUR_TABLE):
+                conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS [{table}] (
+                        ts INTEGER PRIMARY KEY,
+                        samples INTEGER NOT NULL,
+                        players_avg REAL,
+                        players_max REAL,
+                        tick_avg REAL,
+                        tick_min REAL
+                    );
+                """)
+            conn.commit()
+            row = conn.execute(f"SELECT MAX(ts) FROM [{self.MINUTE_TABLE}]").fetchone()
+        # 已经写入数据库的分钟不再重复汇总
+        self._flushed_until = row[0] + 60 if row[0] is not None else 0
+
+    def Record(self, data: dict, ts: Optional[float] = None) -> None:
+        """作为 ServerStatusFeed 的 listener, 每次刷新成功后调用"""
+        ts = ts or time.time()
+        with self._lock:
+            self.Buffer.Append(ts, *(float(data.get(field) or 0) for field in self.FIELDS))
+        if ts >= self._next_flush:
+            self._next_flush = ts + self.FlushInterval
+            try:
+                self.Flush(ts)
+            except Exception as e:
+                _log._ERROR(f"[StatusHistory]x 写入状态历史失败: {e}")
+
+    def Flush(self, now: Optional[float] = None) -> None:
+        """把已经结束的分钟/小时汇总写入数据库"""
+        now = now or time.time()
+        minute_end = int(now // 60 * 60)
+        minutes = {}
+        with self._lock:
+            for ts, players, tick in self.Buffer.Rows():
+                if self._flushed_until <= ts < minute_end:
+                    minutes.setdefault(int(ts // 60 * 60), []).append((players, tick))
+            self._flushed_until = max(self._flushed_until, minute_end)
+        hour_end = minute_end // 3600 * 3600
+        with self._open() as conn:
+            conn.executemany(f"""
+                INSERT OR REPLACE INTO [{self.MINUTE_TABLE}] (ts, samples, players_avg, players_max, tick_avg, tick_min)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [
+                (minute, len(rows), sum(r[0] for r in rows) / len(rows), max(r[0] for r in rows),
+                 sum(r[1] for r in rows) / len(rows), min(r[1] for r in rows))
+                for minute, rows in minutes.items()
+            ])
+            # 重新汇总最近两个已经结束的小时, 覆盖之前写入的不完整数据
+            conn.execute(f"""
+                INSERT OR REPLACE INTO [{self.HOUR_TABLE}] (ts, samples, players_avg, players_max, tick_avg, tick_min)
+                SELECT ts / 3600 * 3600 AS hour, SUM(samples), SUM(players_avg * samples) / SUM(samples),
+                       MAX(players_max), SUM(tick_avg * samples) / SUM(samples), MIN(tick_min)
+                FROM [{self.MINUTE_TABLE}] WHERE ts >= ? AND ts < ?
+                GROUP BY hour
+            """, (hour_end - 2 * 3600, hour_end))
+            conn.execute(f"DELETE FROM [{self.MINUTE_TABLE}] WHERE ts < ?", (now - self.MINUTE_RETENTION,))
+            conn.execute(f"DELETE FROM [{self.HOUR_TABLE}] WHERE ts < ?", (now - self.HOUR_RETENTION,))
+            conn.commit()
+
+    @classmethod
+    def ParseRange(cls, value: str) -> Optional[int]:
+        """解析 30m / 6h / 7d 这样的时间范围, 返回秒数, 格式错误返回 None"""
+        match = re.fullmatch(r"(\d+)([mhd])", (value or "").strip().lower())
+        if not match:
+            return None
+        return int(match.group(1)) * cls.RANGE_UNITS[match.group(2)]
+
+    def Query(self, seconds: int) -> dict:
+        """
+        按范围返回列式数据 {"resolution": "raw"/"1m"/"1h", "data": {"Time": [...], 字段: [...]}}
+        汇总数据额外包含 PlayerRefsMax 和 TickRateMin
+        """
+        now = time.time()
+        since = now - seconds
+        with self._lock:
+            rows = list(self.Buffer.Rows())
+        if rows and rows[0][0] <= since:
+            rows = [row for row in rows if row[0] >= since]
+            columns = list(zip(*rows)) if rows else [[] for _ in range(1 + len(self.FIELDS))]
+            data = {"Time": list(columns[0])}
+            for i, field in enumerate(self.FIELDS, 1):
+                data[field] = list(columns[i])
+            return {"resolution": "raw", "data": data}
+
+        resolution, table = ("1m", self.MINUTE_TABLE) if seconds <= self.MINUTE_RANGE else ("1h", self.HOUR_TABLE)
+        with self._open() as conn:
+            rows = conn.execute(f"""
+                SELECT ts, players_avg, players_max, tick_avg, tick_min FROM [{table}]
+                WHERE ts >= ? ORDER BY ts
+            """, (int(since),)).fetchall()
+        columns = list(zip(*rows)) if rows else [[] for _ in range(5)]
+        return {"resolution": resolution, "data": {
+            "Time": list(columns[0]),
+            "PlayerRefs": list(columns[1]),
+            "PlayerRefsMax": list(columns[2]),
+            "TickRate": list(columns[3]),
+            "TickRateMin": list(columns[4]),
+        }}
@@ -0,0 +1,135 @@
+import json
+import queue
+import threading
+import time
+
+from util.log import _log
+
+def _event(name: str, data) -> str:
+    return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class Subscriber:
+    """一个 SSE 连接, Key 不为空时表示已登录, 会收到玩家列表"""
+    QUEUE_SIZE = 16
+
+    def __init__(self, key: str = None):
+        self.Key = key
+        self.Queue = queue.Queue(self.QUEUE_SIZE)
+        self.Closed = False
+
+    def Send(self, message) -> bool:
+        """放入发送队列, 客户端太慢导致队列已满时返回 False"""
+        try:
+            self.Queue.put_nowait(message)
+            return True
+        except queue.Full:
+            return False
+
+
+class StreamHub:
+    """
+    SSE 广播中心, 只在有订阅者时运行一个后台线程
+    每隔 interval 秒读取一次服务器状态快照和玩家列表缓存, 内容变化时才推送:
+        status   与 /api/server 相同的 {"data", "updated", "stale"}
+        players  第一次为 {"full": [...]}, 之后为 {"added": [...], "removed": [昵称]}
+    连接数达到 max_clients 时拒绝新的订阅, 防止 SSE 连接占满 Web 线程
+    """
+    def __init__(self, status_feed, load_players, interval: float = 5.0, max_clients: int = 32):
+        self._status_feed = status_feed
+        self._load_players = load_players
+        self.Interval = max(0.5, interval)
+        self.MaxClients = max(1, max_clients)
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._thread = None
+        self._status = None
+        self._players = None
+        self.Rejected = 0
+        self.Dropped = 0
+
+    def Subscribe(self, key: str = None):
+        """订阅, 连接数已满时返回 None; 订阅后立即收到当前的状态和玩家列表"""
+        sub = Subscriber(key)
+        with self._lock:
+            if len(self._subscribers) >= self.MaxClients:
+                self.Rejected += 1
+                return None
+            self._subscribers.add(sub)
+            if self._status is not None:
+                sub.Send(_event("status", self._status[1]))
+            if key and self._players is not None:
+                sub.Send(_event("players", {"full": list(self._players.values())}))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="StreamHub", daemon=True)
+                self._thread.start()
+        return sub
+
+    def Unsubscribe(self, sub: Subscriber) -> None:
+        with self._lock:
+            self._subscribers.discard(sub)
+        sub.Closed = True
+
+    def _broadcast(self, message: str, logged_in_only: bool = False) -> None:
+        with self._lock:
+            targets = [sub for sub in self._subscribers if sub.Key or not logged_in_only]
+        for sub in targets:
+            if not sub.Send(message):
+                # 跟不上推送的客户端直接断开, 浏览器会自动重连并拿到完整数据
+                self.Unsubscribe(sub)
+                sub.Queue.queue.clear()
+                sub.Send(None)
+                self.Dropped += 1
+
+    def _poll_status(self) -> None:
+        snapshot = self._status_feed.Get()
+        state = (snapshot["data"], snapshot["stale"])
+        if self._status is not None and self._status[0] == state:
+            return
+        self._status = (state, snapshot)
+        self._broadcast(_event("status", snapshot))
+
+    def _poll_players(self) -> None:
+        with self._lock:
+            keys = [sub.Key for sub in self._subscribers if sub.Key]
+        if not keys:
+            return
+        players = self._load_players(keys[-1])
+        if players is None:
+            return
+        current = {player["Name"]: player for player in players}
+        previous = self._players
+        if previous is None:
+            self._players = current
+            self._broadcast(_event("players", {"full": players}), logged_in_only=True)
+            return
+        added = [player for name, player in current.items() if previous.get(name) != player]
+        removed = [name for name in previous if name not in current]
+        if added or removed:
+            self._players = current
+            self._broadcast(_event("players", {"added": added, "removed": removed}), logged_in_only=True)
+
+    def _loop(self) -> None:
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    # 没有订阅者时退出, 下次订阅重新启动
+                    self._thread = None
+                    self._status = None
+                    self._players = None
+                    return
+            try:
+                self._poll_status()
+                self._poll_players()
+            except Exception as e:
+                _log._ERROR(f"[StreamHub]x 推送服务器状态失败: {e}")
+            time.sleep(self.Interval)
+
+    def Stats(self) -> dict:
+        with self._lock:
+            return {
+                "clients": len(self._subscribers),
+                "max_clients": self.MaxClients,
+                "rejected": self.Rejected,
+                "dropped": self.Dropped,
+            }
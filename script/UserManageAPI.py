@@ -1,16 +1,64 @@
 import os
 import shutil
-import yaml
-from PIL import Image
+import threading
+import time
 
 from script.SqliteModule import SqliteUserData
+from script.SqliteBlob import BLOB_CHUNK_SIZE
+from script.AvatarWorker import AvatarQueue, process_avatar
 from script.WebUserManage import RegisterUser
 
 from util.log import _log
-from util.YamlRead import UserDataPath, real, module
+from util.YamlRead import (
+    UserDataPath, real, module, SqlitePoolSize, DataCacheSize, DataCacheTTL,
+    AvatarWorkers, AvatarQueueSize, AvatarMaxPixels, CompressFiles
+)
 from util.security import PasswordHelper
+from util.YamlFile import read_yaml, write_yaml
 
-sql = SqliteUserData(user_data_root=UserDataPath, real=real, module=module)
+# 用户权限索引, 缓存 BasicUserInfo.yaml 中的 Tags
+# 文件可能被游戏服务器修改, 每隔 RECHECK 秒按 mtime 重新校验一次
+class RoleIndex:
+    RECHECK = 2.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._roles = {}
+
+    def _path(self, uid: str) -> str:
+        return f"{UserDataPath}/User/{uid}/BasicUserInfo.yaml"
+
+    def Get(self, uid: str) -> frozenset:
+        """获取用户的 Tags, 用户实例不存在时抛出 FileNotFoundError"""
+        now = time.monotonic()
+        entry = self._roles.get(uid)
+        if entry and now - entry[2] < self.RECHECK:
+            return entry[1]
+        mtime = os.stat(self._path(uid)).st_mtime_ns
+        if entry and entry[0] == mtime:
+            entry[2] = now
+            return entry[1]
+        data = read_yaml(self._path(uid))
+        return self.Set(uid, data.get("Tags") or [], mtime)
+
+    def Set(self, uid: str, tags: list, mtime: int = None) -> frozenset:
+        """写入 Yaml 之后调用, 直接更新索引"""
+        if mtime is None:
+            mtime = os.stat(self._path(uid)).st_mtime_ns
+        tags = frozenset(tags)
+        with self._lock:
+            self._roles[uid] = [mtime, tags, time.monotonic()]
+        return tags
+
+    def Remove(self, uid: str) -> None:
+        with self._lock:
+            self._roles.pop(uid, None)
+
+roles = RoleIndex()
+
+sql = SqliteUserData(user_data_root=UserDataPath, real=real, module=module, pool_size=SqlitePoolSize,
+                     data_cache_size=DataCacheSize, data_cache_ttl=DataCacheTTL,
+                     compress_files=CompressFiles)
 
 # 创建一个新的用户
 def CreateUserData(uid: str, pwd: str, email: str = None) -> list:
@@ -27,27 +75,66 @@ def CreateUserData(uid: str, pwd: str, email: str = None) -> list:
 # 重置密钥
 def ReGetKey(uid: str) -> str:
     resultKey = sql.RegetKey(uid)
+    if not resultKey:
+        _log._ERROR(f"[ReGetKey]x 重置密钥失败, 用户 {uid} 不存在")
+        return resultKey
     _log._INFO(f"[ReGetKey]√ 重置密钥成功, 用户 {uid} 绑定密钥: {resultKey}")
     return resultKey
 
-# 初始化/修改用户的实例
-def InsertBasicInfo(uid: str):
-    config_path = f"{UserDataPath}/User/{uid}/BasicUserInfo.yaml"
-    with open(config_path, "rb") as f:
-        sql.insert_data(uid=uid, name="BasicUserInfo", data_type=None, stream=f)
+# 初始化/修改用户的实例, 已经解析过的 data 可以直接传入, 不再重复读取文件
+def InsertBasicInfo(uid: str, data: dict = None):
+    if data is None:
+        data = read_yaml(f"{UserDataPath}/User/{uid}/BasicUserInfo.yaml")
+    sql.insert_data_dict(uid, "BasicUserInfo", data)
     _log._INFO(f"[InsertBasicInfo]√ 用户 {uid} 实例操作成功")
 
+_basic_info_lock = threading.Lock()
+
+# 读取-修改-写入 BasicUserInfo, 只解析一次, 原子写回后直接把 dict 写入数据库
+# mutate(data) 返回 False 表示没有改动, 此时不会写文件和数据库
+def UpdateBasicInfo(uid: str, mutate) -> bool:
+    config_path = f"{UserDataPath}/User/{uid}/BasicUserInfo.yaml"
+    with _basic_info_lock:
+        data = read_yaml(config_path)
+        data.setdefault('Tags', [])
+        if mutate(data) is False:
+            return False
+        write_yaml(config_path, data)
+        roles.Set(uid, data['Tags'])
+        InsertBasicInfo(uid, data)
+    return True
+
+# 头像的各个尺寸, avatar.png 是游戏服务器使用的 64x64 头像
+AVATAR_SIZES = {32: "avatar.32.png", 64: "avatar.png", 128: "avatar.128.png"}
+
+def _AvatarOutputs(uid: str) -> dict:
+    return {size: f"{UserDataPath}/User/{uid}/{name}" for size, name in AVATAR_SIZES.items()}
+
+# 把 User/{uid} 下的各尺寸头像写入数据库
+def StoreAvatar(uid: str) -> bool:
+    try:
+        with sql.Batch:
+            for name in AVATAR_SIZES.values():
+                config_path = f"{UserDataPath}/User/{uid}/{name}"
+                if name != "avatar.png" and not os.path.exists(config_path):
+                    continue
+                with open(config_path, "rb") as f:
+                    with sql.write_file(uid, name, size=os.fstat(f.fileno()).st_size) as stream:
+                        shutil.copyfileobj(f, stream, BLOB_CHUNK_SIZE)
+        _log._INFO(f"[InsertAvatar]√ 用户 {uid} 头像修改成功")
+        return True
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        _log._ERROR(f"[InsertAvatar]x 用户 {uid} 修改头像失败: {e}")
+        return False
+
 # 初始化/修改用户的头像
 def InsertAvatar(uid: str) -> bool:
-    # 尝试从全局头像中快速绑定头像并更改64x64
+    # 尝试从全局头像中快速绑定头像并生成各尺寸头像
     if os.path.exists(f"{UserDataPath}/GlobalAvatar"):
         try:
-            with Image.open(f"{UserDataPath}/GlobalAvatar/{uid}.png") as img:
-                img.resize((64, 64), Image.Resampling.LANCZOS).save(
-                    f"{UserDataPath}/User/{uid}/avatar.png",
-                    'PNG',
-                    optimize=True
-                )
+            process_avatar(f"{UserDataPath}/GlobalAvatar/{uid}.png", _AvatarOutputs(uid), AvatarMaxPixels)
             _log._INFO(f"[InsertAvatar]√ 用户 {uid} 全局头像初始成功")
         except FileNotFoundError:
             pass
@@ -55,29 +142,51 @@ def InsertAvatar(uid: str) -> bool:
             _log._ERROR(f"[InsertAvatar]x 用户 {uid} 全局头像初始错误: {e}")
     else:
         os.makedirs(f"{UserDataPath}/GlobalAvatar")
-    try:
-        config_path = f"{UserDataPath}/User/{uid}/avatar.png"
-        with open(config_path, "rb") as f:
-            with sql.write_file(uid, "avatar.png") as stream:
-                stream.write(f.read())
-        _log._INFO(f"[InsertAvatar]√ 用户 {uid} 头像修改成功")
-        return True
-    except FileNotFoundError:
-        return False
-    except Exception as e:
-        _log._ERROR(f"[InsertAvatar]x 用户 {uid} 修改头像失败: {e}")
-        return False
+    return StoreAvatar(uid)
+
+avatar_queue = AvatarQueue(AvatarWorkers, AvatarQueueSize, StoreAvatar)
+
+# 把已经保存到 GlobalAvatar 的上传头像交给后台进程处理, 返回任务id, 队列已满时返回None
+def SubmitAvatar(uid: str) -> str:
+    job_id = avatar_queue.Submit(
+        uid,
+        f"{UserDataPath}/GlobalAvatar/{uid}.png",
+        _AvatarOutputs(uid),
+        AvatarMaxPixels
+    )
+    if job_id is None:
+        _log._WARN(f"[SubmitAvatar]x 头像处理队列已满, 拒绝用户 {uid} 的请求")
+    return job_id
+
+# 查找头像, 没有对应尺寸时退回64x64, 用户没有头像时退回Guest
+# 返回 (uid, 文件名, ETag), 都没有时返回None
+def FindAvatar(uid: str, size: int = 64):
+    name = AVATAR_SIZES.get(size, "avatar.png")
+    for candidate_uid in dict.fromkeys((uid, "Guest")):
+        for candidate_name in dict.fromkeys((name, "avatar.png")):
+            etag = sql.GetFileHash(candidate_uid, candidate_name)
+            if etag:
+                return candidate_uid, candidate_name, etag
+    return None
+
+# 读取头像内容
+def ReadAvatar(uid: str, name: str) -> bytes:
+    reader = sql.open_file(uid, name)
+    if reader is None:
+        return None
+    with reader:
+        return reader.read()
+
+# 查询头像处理任务
+def GetAvatarJob(job_id: str) -> dict:
+    return avatar_queue.Status(job_id)
 
 # 修改昵称
 def ChangeName(uid: str, name: str) -> bool:
-    config_path = f"{UserDataPath}/User/{uid}/BasicUserInfo.yaml"
-    try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            data = yaml.safe_load(f) or {}
+    def mutate(data):
         data['Name'] = name
-        with open(config_path, 'w', encoding='utf-8') as f:
-            yaml.dump(data, f, sort_keys=False, allow_unicode=True)
-        InsertBasicInfo(uid)
+    try:
+        UpdateBasicInfo(uid, mutate)
         _log._INFO(f"[ChangeName]√ {uid} 修改昵称 {name} 成功")
         return True
     except Exception as e:
@@ -86,15 +195,12 @@ def ChangeName(uid: str, name: str) -> bool:
 
 # 赋予玩家管理员
 def GiveOP(uid: str) -> bool:
-    config_path = f"{UserDataPath}/User/{uid}/BasicUserInfo.yaml"
+    def mutate(data):
+        if 'admin' in data['Tags']:
+            return False
+        data['Tags'].append('admin')
     try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            data = yaml.safe_load(f) or {}
-        if 'admin' not in data['Tags']:
-            data['Tags'].append('admin')
-            with open(config_path, 'w', encoding='utf-8') as f:
-                yaml.dump(data, f, sort_keys=False, allow_unicode=True)
-        InsertBasicInfo(uid)
+        UpdateBasicInfo(uid, mutate)
         _log._INFO(f"[GiveOP]√ {uid} 赋予管理员成功")
         return True
     except Exception as e:
@@ -103,22 +209,16 @@ def GiveOP(uid: str) -> bool:
     
 # 赋予玩家超级管理员
 def GiveSuperOP(uid: str) -> bool:
-    config_path = f"{UserDataPath}/User/{uid}/BasicUserInfo.yaml"
-    try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            data = yaml.safe_load(f) or {}
+    def mutate(data):
+        if 'superadmin' in data['Tags']:
+            return False
         if 'admin' not in data['Tags']:
             data['Tags'].append('admin')
-            with open(config_path, 'w', encoding='utf-8') as f:
-                yaml.dump(data, f, sort_keys=False, allow_unicode=True)
-        if 'superadmin' not in data['Tags']:
-            data['Tags'].append('superadmin')
-            with open(config_path, 'w', encoding='utf-8') as f:
-                yaml.dump(data, f, sort_keys=False, allow_unicode=True)
-        else:
+        data['Tags'].append('superadmin')
+    try:
+        if not UpdateBasicInfo(uid, mutate):
             _log._INFO(f"[GiveSuperOP]√ {uid} 已经是超级管理员")
             return True
-        InsertBasicInfo(uid)
         _log._INFO(f"[GiveSuperOP]√ {uid} 赋予超级管理员成功")
         return True
     except FileNotFoundError:
@@ -129,18 +229,14 @@ def GiveSuperOP(uid: str) -> bool:
 
 # 移除玩家管理员
 def DeOP(uid: str) -> bool:
-    config_path = f"{UserDataPath}/User/{uid}/BasicUserInfo.yaml"
+    def mutate(data):
+        if 'admin' not in data['Tags']:
+            return False
+        data['Tags'].remove('admin')
     try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            data = yaml.safe_load(f) or {}
-        if 'Tags' in data and 'admin' in data['Tags']:
-            data['Tags'].remove('admin')
-            with open(config_path, 'w', encoding='utf-8') as f:
-                yaml.dump(data, f, sort_keys=False, allow_unicode=True)
-        else:
+        if not UpdateBasicInfo(uid, mutate):
             _log._INFO(f"[DeOP]x {uid} 不是管理员")
             return False
-        InsertBasicInfo(uid)
         _log._INFO(f"[DeOP]√ {uid} 回收管理员成功")
         return True    
     except Exception as e:
@@ -149,18 +245,14 @@ def DeOP(uid: str) -> bool:
     
 # 移除玩家超级管理员
 def DeSuperOP(uid: str) -> bool:
-    config_path = f"{UserDataPath}/User/{uid}/BasicUserInfo.yaml"
+    def mutate(data):
+        if 'superadmin' not in data['Tags']:
+            return False
+        data['Tags'].remove('superadmin')
     try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            data = yaml.safe_load(f) or {}
-        if 'Tags' in data and 'superadmin' in data['Tags']:
-            data['Tags'].remove('superadmin')
-            with open(config_path, 'w', encoding='utf-8') as f:
-                yaml.dump(data, f, sort_keys=False, allow_unicode=True)
-        else:
+        if not UpdateBasicInfo(uid, mutate):
             _log._INFO(f"[DeSuperOP]x {uid} 不是超级管理员")
             return False
-        InsertBasicInfo(uid)
         _log._INFO(f"[DeSuperOP]√ {uid} 回收超级管理员成功")
         return True    
     except Exception as e:
@@ -172,6 +264,7 @@ def RemoveUser(uid: str) -> bool:
     try:
         if not sql.Wipe(uid):
             return False
+        roles.Remove(uid)
         _log._INFO(f"[RemoveUser]√ 用户 {uid} 数据删除成功")
         shutil.rmtree(f"{UserDataPath}/User/{uid}")
         _log._INFO(f"[RemoveUser]√ 用户 {uid} 缓存删除成功")
@@ -183,6 +276,10 @@ def RemoveUser(uid: str) -> bool:
         _log._WARN(f"[RemoveUser]x 删除用户 {uid} 缓存时发生错误: {e}")
     return True
 
+# 批量清理未注册且没有数据的用户, 以及meta中已不存在的孤立数据
+def CleanupUsers() -> dict:
+    return sql.CleanupOrphans()
+
 # 检查Ban信息
 def GetBanInfo(uid: str) -> dict:
     data = sql.GetBanData(uid)
@@ -191,6 +288,41 @@ def GetBanInfo(uid: str) -> dict:
         data = {}
     return data
 
+# 批量检查Ban信息, 未被Ban的用户返回{}
+def GetBanInfoMany(uids: list) -> dict:
+    return {uid: data or {} for uid, data in sql.GetBanDataMany(uids)}
+
+# 批量读取用户实例, 不存在的用户不会出现在结果中
+def GetBasicInfoMany(uids: list) -> dict:
+    return {uid: data for uid, data in sql.get_data_many(uids, "BasicUserInfo") if data is not None}
+
+# 分页查询当前生效的封禁
+def GetActiveBans(limit: int = 50, after: str = None) -> list:
+    return sql.GetActiveBans(limit=limit, after=after)
+
+# 后台定期对账封禁索引并清除过期的封禁记录
+def StartBanSweeper(interval: float) -> threading.Thread:
+    def loop():
+        while not _ban_sweeper_stop.wait(interval):
+            try:
+                # 游戏服务器直接写入/删除的封禁不会经过 insert_ban, 先对账再清除
+                count = sql.SyncBanIndex()
+                if count:
+                    _log._INFO(f"[BanSweeper]√ 同步封禁索引 {count} 条")
+            except Exception as e:
+                _log._ERROR(f"[BanSweeper]x 同步封禁索引失败: {e}")
+            try:
+                count = sql.SweepExpiredBans()
+                if count:
+                    _log._INFO(f"[BanSweeper]√ 清除过期封禁 {count} 条")
+            except Exception as e:
+                _log._ERROR(f"[BanSweeper]x 清除过期封禁失败: {e}")
+    thread = threading.Thread(target=loop, name="BanSweeper", daemon=True)
+    thread.start()
+    return thread
+
+_ban_sweeper_stop = threading.Event()
+
 # Ban一名玩家
 def BanUser(uid, minutes=0, days=0, Reason="None Reason") -> dict:
     return sql.insert_ban(uid, minutes=minutes, days=days, Reason=Reason)
@@ -204,55 +336,64 @@ def DeBan(uid: str) -> bool:
         _log._ERROR(f"[DeBan]x 用户 {uid} Ban记录清空失败")
     return data
 
-# 查询用户信息
-def GetUserInfo(index: str) -> dict:
-    result_dict = {
-        "uid": None,
-        "key": None,
-        "name": None,
-        "Avatar": False,
-        "Admin": False,
-        "SuperAdmin": False,
-        "Email": None
+def _IsKeyIndex(index: str) -> bool:
+    return len(index) == 16 and all(i in '0123456789abcdefABCDEF' for i in index)
+
+def _FormatUserInfo(uid: str, key: str, email: str, avatar: bool, data: dict) -> dict:
+    tags = (data or {}).get("Tags") or []
+    return {
+        "uid": uid,
+        "key": key,
+        "name": (data or {}).get("Name"),
+        "Avatar": avatar,
+        "Admin": "admin" in tags,
+        "SuperAdmin": "superadmin" in tags,
+        "Email": email
     }
-    if len(index) == 16 and all(i in '0123456789abcdefABCDEF' for i in index):
-        result_dict["key"] = index
-        result_dict["uid"] = sql.GetUID(index)
-    else:
-        result_dict["uid"] = index
-        result_dict["key"] = sql.GetKey(index)
-    if result_dict["uid"] == "" or result_dict["key"] == "":
+
+# 查询用户信息, index 可以是 uid 或 key
+# meta/邮箱/头像一次查询, 昵称和权限来自已解码缓存的 BasicUserInfo
+def GetUserInfo(index: str) -> dict:
+    row = next(sql.GetUserRows([index], by_key=_IsKeyIndex(index)), None)
+    if row is None:
         _log._WARN(f"[GetUserInfo]x 未匹配到索引 {index} 的信息")
         return None
-    with sql.Open() as conn:
-        cursor = conn.execute("""
-            SELECT email FROM [usertool.user] WHERE uid = ?
-        """, (result_dict["uid"],))
-        pwd_result = cursor.fetchone()
-        if pwd_result:
-            result_dict["Email"] = pwd_result[0]
-    with open(f"{UserDataPath}/User/{result_dict['uid']}/BasicUserInfo.yaml", 'r', encoding='utf-8') as f:
-        data = yaml.safe_load(f) or {}
-    result_dict["name"] = data["Name"]
-    if "admin" in data["Tags"]:
-        result_dict["Admin"] = True
-    if "superadmin" in data["Tags"]:
-        result_dict["SuperAdmin"] = True
-    if os.path.exists(os.path.join(f"{UserDataPath}/User/{result_dict['uid']}", "avatar.png")):
-        result_dict["Avatar"] = True
-    _log._INFO(f"[GetUserInfo]{result_dict}")
-    return result_dict
+    uid = row[0]
+    return _FormatUserInfo(*row, sql.get_data(uid, "BasicUserInfo"))
+
+# 批量查询用户信息, 返回 {uid: info}, 不存在的用户不会出现在结果中
+def GetUserInfoMany(uids: list) -> dict:
+    rows = list(sql.GetUserRows(uids))
+    data = GetBasicInfoMany([row[0] for row in rows])
+    return {row[0]: _FormatUserInfo(*row, data.get(row[0])) for row in rows}
+
+# 管理员用户目录, 返回 (本页用户, 下一页游标)
+# admin 条件来自 BasicUserInfo 的 Tags, 无法在 SQL 中过滤, 按页继续向后扫描直到凑满一页
+# 最多扫描 max_scan 页, 没凑满时也返回游标, 前端继续翻页即可
+def ListUsers(limit: int = 50, after: int = 0, prefix: str = None, admin: bool = None,
+              banned: bool = None, max_scan: int = 20) -> tuple:
+    users = []
+    cursor = after or 0
+    for _ in range(max_scan):
+        rows = sql.ListUsers(limit=limit, after=cursor, prefix=prefix, banned=banned)
+        infos = GetUserInfoMany([row[1] for row in rows])
+        for iid, uid, is_banned in rows:
+            cursor = iid
+            info = infos.get(uid)
+            if info is None or (admin is not None and info["Admin"] != admin):
+                continue
+            info.pop("key")
+            info["Banned"] = is_banned
+            info["iid"] = iid
+            users.append(info)
+            if len(users) == limit:
+                return users, iid
+        if len(rows) < limit:
+            return users, None
+    return users, cursor
 
 def is_CheckAdmin(uid: str) -> bool:
-    with open(f"{UserDataPath}/User/{uid}/BasicUserInfo.yaml", 'r', encoding='utf-8') as f:
-        data = yaml.safe_load(f) or {}
-    if "admin" in data["Tags"]:
-        return True
-    return False
+    return "admin" in roles.Get(uid)
 
 def is_CheckSuperAdmin(uid: str) -> bool:
-    with open(f"{UserDataPath}/User/{uid}/BasicUserInfo.yaml", 'r', encoding='utf-8') as f:
-        data = yaml.safe_load(f) or {}
-    if "superadmin" in data["Tags"]:
-        return True
-    return False
\ No newline at end of file
+    return "superadmin" in roles.Get(uid)
@@ -1,15 +1,17 @@
 import sqlite3
 from script.SqliteModule import SqliteUserData
 from util.log import _log
-from util.YamlRead import UserDataPath
-from util.security import PasswordHelper
+from util.YamlRead import UserDataPath, SqlitePoolSize, HashWorkers, HashQueueSize, PasswordIterations, WebThreads
+from util.security import HashPool, HashPoolBusy, PasswordHelper
 
-sql = SqliteUserData(user_data_root=UserDataPath, real="UserTool", module="Web.User")
+sql = SqliteUserData(user_data_root=UserDataPath, real="UserTool", module="Web.User", pool_size=SqlitePoolSize)
+# 密码哈希在独立的线程池中计算, 队列满时抛出 HashPoolBusy, 由 Web 层返回 503
+# 等待哈希的请求仍然占着 Web 线程, 排队上限必须小于 Web 线程数, 至少留一个线程给其他请求
+hash_pool = HashPool(HashWorkers, min(HashQueueSize, max(1, WebThreads - 1)))
 
 def RegisterUser(uid: str, password: str, email: str = None) -> bool:
     """注册用户"""
-    salt = PasswordHelper.generate_salt()
-    password_hash = PasswordHelper.hash_password(password, salt)
+    password_hash, salt = hash_pool.Hash(password, PasswordIterations)
     try:
         with sql.Open() as conn:
             conn.execute("""
@@ -31,22 +33,44 @@ def VerifyUserPassword(uid: str, password: str) -> bool:
         """, (uid,))
         result = cursor.fetchone()
         
-        if not result:
-            _log._WARN(f"[VerifyUserPassword]x 用户 {uid} 不存在")
-            return False
-            
-        stored_hash, salt = result
-        if PasswordHelper.verify_password(password, salt, stored_hash):
-            _log._INFO(f"[VerifyUserPassword]√ 用户 {uid} 密码验证成功")
-            return True
-        else:
-            _log._WARN(f"[VerifyUserPassword]x 用户 {uid} 密码验证失败")
-            return False
+    if not result:
+        _log._WARN(f"[VerifyUserPassword]x 用户 {uid} 不存在")
+        return False
+        
+    # 先归还连接再计算哈希, 避免哈希期间占用连接池
+    stored_hash, salt = result
+    if hash_pool.Verify(password, salt, stored_hash):
+        _log._INFO(f"[VerifyUserPassword]√ 用户 {uid} 密码验证成功")
+        if PasswordHelper.needs_rehash(stored_hash, PasswordIterations):
+            RehashPassword(uid, password, stored_hash)
+        return True
+    else:
+        _log._WARN(f"[VerifyUserPassword]x 用户 {uid} 密码验证失败")
+        return False
+
+def RehashPassword(uid: str, password: str, old_hash: str) -> bool:
+    """
+    登录成功后按当前的 PasswordIterations 重新哈希
+    只在哈希没有被其他请求修改时写入; 哈希队列繁忙时跳过, 下次登录再处理
+    """
+    try:
+        new_hash, salt = hash_pool.Hash(password, PasswordIterations)
+    except HashPoolBusy:
+        return False
+    with sql.Open() as conn:
+        cursor = conn.execute("""
+            UPDATE [usertool.user]
+            SET password_hash = ?, salt = ?
+            WHERE uid = ? AND password_hash = ?
+        """, (new_hash, salt, uid, old_hash))
+        conn.commit()
+    if cursor.rowcount:
+        _log._INFO(f"[RehashPassword]√ 用户 {uid} 密码哈希已更新为 {PasswordIterations} 次迭代")
+    return cursor.rowcount > 0
 
 def UpdateUserPassword(uid: str, new_password: str) -> bool:
     """更新用户密码"""
-    salt = PasswordHelper.generate_salt()
-    new_hash = PasswordHelper.hash_password(new_password, salt)
+    new_hash, salt = hash_pool.Hash(new_password, PasswordIterations)
     
     with sql.Open() as conn:
         conn.execute("""
@@ -0,0 +1,39 @@
+import os
+import tempfile
+import yaml
+
+# 优先使用 libyaml 的 C 实现, 没有编译 libyaml 时退回纯 Python 实现
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+def load_yaml(stream):
+    """解析 Yaml 字符串或文件流"""
+    return yaml.load(stream, Loader=SafeLoader)
+
+def read_yaml(path: str) -> dict:
+    """读取 Yaml 文件, 空文件返回 {}"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return load_yaml(f) or {}
+
+def write_yaml(path: str, data) -> None:
+    """先写入同目录临时文件再 rename 覆盖, 其他进程不会读到写了一半的文件"""
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".yaml")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            yaml.dump(data, f, Dumper=SafeDumper, sort_keys=False, allow_unicode=True)
+        # mkstemp 创建的文件只有属主可读, 沿用原文件的权限
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
@@ -12,10 +12,40 @@ DEFAULT_CONFIG = {
     'WebTitle': 'CelesteNetCN',
     'WebHost': '0.0.0.0',
     'WebPort': '17238',
+    'WebThreads': 4,
     'JWT_SECRET_KEY': 'abcdefgh12345678',
     'JWT_ACCESS_TOKEN_EXPIRES_MINUTES': 60,
     'SuperAdmin': None,
-    'RemoveSuperAdmin': None
+    'RemoveSuperAdmin': None,
+    'SqlitePoolSize': 8,
+    'DataCacheSize': 4096,
+    'DataCacheTTL': 30,
+    'BanSweepInterval': 60,
+    'AvatarWorkers': 2,
+    'AvatarQueueSize': 16,
+    'AvatarMaxBytes': 4194304,
+    'AvatarMaxPixels': 16777216,
+    'CompressFiles': True,
+    'HashWorkers': 2,
+    'HashQueueSize': 3,
+    'PasswordIterations': 100000,
+    'LoginIPRate': 10,
+    'LoginIPBurst': 20,
+    'LoginUidRate': 5,
+    'LoginUidBurst': 10,
+    'LoginRateShared': False,
+    'ServerStatusInterval': 5,
+    'ServerStatusMaxAge': 60,
+    'CelesteNetPoolSize': 8,
+    'CelesteNetConnectTimeout': 2,
+    'CelesteNetReadTimeout': 3,
+    'CelesteNetRetries': 1,
+    'CelesteNetBreakerThreshold': 5,
+    'CelesteNetBreakerCooldown': 30,
+    'PlayerListTTL': 3,
+    'StreamMaxClients': 32,
+    'StreamLifetime': 300,
+    'StatusHistorySize': 720
 }
 
 _config: Dict[str, Any] = {}
@@ -58,7 +88,37 @@ CelesteNetWebRedirect = get_config('CelesteNetWebRedirect')
 WebTitle = get_config('WebTitle')
 WebHost = get_config('WebHost')
 WebPort = get_config('WebPort')
+WebThreads = int(get_config('WebThreads'))
 JWT_SECRET_KEY = get_config('JWT_SECRET_KEY')
 JWT_ACCESS_TOKEN_EXPIRES_MINUTES = int(get_config('JWT_ACCESS_TOKEN_EXPIRES_MINUTES'))
 SuperAdmin = get_config('SuperAdmin')
-RemoveSuperAdmin = get_config('RemoveSuperAdmin')
\ No newline at end of file
+RemoveSuperAdmin = get_config('RemoveSuperAdmin')
+SqlitePoolSize = int(get_config('SqlitePoolSize'))
+DataCacheSize = int(get_config('DataCacheSize'))
+DataCacheTTL = float(get_config('DataCacheTTL') or 0)
+BanSweepInterval = float(get_config('BanSweepInterval') or 0)
+AvatarWorkers = int(get_config('AvatarWorkers'))
+AvatarQueueSize = int(get_config('AvatarQueueSize'))
+AvatarMaxBytes = int(get_config('AvatarMaxBytes'))
+AvatarMaxPixels = int(get_config('AvatarMaxPixels'))
+CompressFiles = bool(get_config('CompressFiles'))
+HashWorkers = int(get_config('HashWorkers'))
+HashQueueSize = int(get_config('HashQueueSize'))
+PasswordIterations = int(get_config('PasswordIterations'))
+LoginIPRate = float(get_config('LoginIPRate') or 0)
+LoginIPBurst = float(get_config('LoginIPBurst'))
+LoginUidRate = float(get_config('LoginUidRate') or 0)
+LoginUidBurst = float(get_config('LoginUidBurst'))
+LoginRateShared = bool(get_config('LoginRateShared'))
+ServerStatusInterval = float(get_config('ServerStatusInterval'))
+ServerStatusMaxAge = float(get_config('ServerStatusMaxAge'))
+CelesteNetPoolSize = int(get_config('CelesteNetPoolSize'))
+CelesteNetConnectTimeout = float(get_config('CelesteNetConnectTimeout'))
+CelesteNetReadTimeout = float(get_config('CelesteNetReadTimeout'))
+CelesteNetRetries = int(get_config('CelesteNetRetries'))
+CelesteNetBreakerThreshold = int(get_config('CelesteNetBreakerThreshold'))
+CelesteNetBreakerCooldown = float(get_config('CelesteNetBreakerCooldown'))
+PlayerListTTL = float(get_config('PlayerListTTL'))
+StreamMaxClients = int(get_config('StreamMaxClients'))
+StreamLifetime = float(get_config('StreamLifetime'))
+StatusHistorySize = int(get_config('StatusHistorySize'))
\ No newline at end of file
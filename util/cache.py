@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+_MISSING = object()
+
+class LRUCache:
+    """线程安全的 LRU 缓存, 可选 TTL(秒), 记录命中率和淘汰次数"""
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.MaxSize = max(1, maxsize)
+        self.TTL = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.Hits = 0
+        self.Misses = 0
+        self.Evictions = 0
+        self.Expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self.Misses += 1
+                return default
+            value, expires = item
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                self.Expirations += 1
+                self.Misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.Hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        expires = time.monotonic() + self.TTL if self.TTL else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.MaxSize:
+                self._data.popitem(last=False)
+                self.Evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+            return default if item is _MISSING else item[0]
+
+    def discard_where(self, predicate) -> int:
+        """删除所有 predicate(key) 为真的条目, 返回删除数量"""
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            return item is not _MISSING and (item[1] is None or item[1] > time.monotonic())
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def Stats(self) -> dict:
+        with self._lock:
+            lookups = self.Hits + self.Misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.MaxSize,
+                "hits": self.Hits,
+                "misses": self.Misses,
+                "hit_ratio": self.Hits / lookups if lookups else 0.0,
+                "evictions": self.Evictions,
+                "expirations": self.Expirations,
+            }
+
+
+class SingleFlightValue:
+    """
+    单个值的短时缓存, 过期后并发的 get 只有一个线程执行 loader, 其余线程等待同一个结果
+    loader 返回 None 视为失败, 不会缓存; 等待超过 wait_timeout 的线程返回上一次成功的值(可能已过期)
+    """
+    def __init__(self, ttl: float):
+        self.TTL = ttl
+        self._lock = threading.Lock()
+        self._value = None
+        self._expires = 0.0
+        self._flight = None
+        self.Hits = 0
+        self.Loads = 0
+        self.Coalesced = 0
+
+    def get(self, loader, wait_timeout: Optional[float] = None) -> Any:
+        with self._lock:
+            if self._value is not None and time.monotonic() < self._expires:
+                self.Hits += 1
+                return self._value
+            flight = self._flight
+            leader = flight is None
+            if leader:
+                flight = self._flight = {"done": threading.Event(), "value": None}
+                self.Loads += 1
+            else:
+                self.Coalesced += 1
+        if not leader:
+            if flight["done"].wait(wait_timeout):
+                return flight["value"]
+            with self._lock:
+                return self._value
+        try:
+            value = loader()
+            flight["value"] = value
+            if value is not None:
+                with self._lock:
+                    self._value = value
+                    self._expires = time.monotonic() + self.TTL
+            return value
+        finally:
+            with self._lock:
+                self._flight = None
+            flight["done"].set()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._value = None
+            self._expires = 0.0
+
+    def Stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.Hits, "loads": self.Loads, "coalesced": self.Coalesced}
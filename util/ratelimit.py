@@ -0,0 +1,90 @@
+import threading
+import time
+from typing import Tuple
+
+class TokenBucketLimiter:
+    """
+    内存令牌桶限流, 每个 key 一个桶, 每秒补充 rate 个令牌, 最多积攒 burst 个
+    桶按 key 的哈希分散到多个分片, 每个分片一把锁; 补满且闲置的桶定期清除
+    """
+    def __init__(self, rate: float, burst: float, shards: int = 16, sweep_interval: float = 60.0):
+        self.Rate = rate
+        self.Burst = max(1.0, burst)
+        self.SweepInterval = sweep_interval
+        self._shards = [({}, threading.Lock()) for _ in range(max(1, shards))]
+        self._next_sweep = [time.monotonic() + sweep_interval] * len(self._shards)
+
+    def _sweep(self, index: int, buckets: dict, now: float) -> None:
+        # 闲置到足以补满的桶和新桶没有区别, 直接删除
+        idle = self.Burst / self.Rate if self.Rate > 0 else self.SweepInterval
+        expired = [key for key, (_, updated) in buckets.items() if now - updated >= idle]
+        for key in expired:
+            del buckets[key]
+        self._next_sweep[index] = now + self.SweepInterval
+
+    def Take(self, key: str) -> Tuple[bool, float]:
+        """消耗一个令牌, 返回 (是否允许, 需要等待的秒数)"""
+        now = time.monotonic()
+        index = hash(key) % len(self._shards)
+        buckets, lock = self._shards[index]
+        with lock:
+            if now >= self._next_sweep[index]:
+                self._sweep(index, buckets, now)
+            tokens, updated = buckets.get(key, (self.Burst, now))
+            tokens = min(self.Burst, tokens + (now - updated) * self.Rate)
+            if tokens < 1:
+                buckets[key] = (tokens, now)
+                return False, (1 - tokens) / self.Rate if self.Rate > 0 else self.SweepInterval
+            buckets[key] = (tokens - 1, now)
+            return True, 0.0
+
+    def __len__(self) -> int:
+        return sum(len(buckets) for buckets, _ in self._shards)
+
+
+class SqliteTokenBucketLimiter:
+    """
+    与 TokenBucketLimiter 相同的令牌桶, 状态保存在 SQLite 中, 多个进程共用同一份限流
+    open_conn 为返回连接上下文的函数, 例如 SqliteUserData.Open
+    """
+    TABLE = "usertool.ratelimit"
+
+    def __init__(self, open_conn, rate: float, burst: float, sweep_interval: float = 60.0):
+        self.Rate = rate
+        self.Burst = max(1.0, burst)
+        self.SweepInterval = sweep_interval
+        self._open = open_conn
+        self._next_sweep = time.time() + sweep_interval
+        with self._open() as conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS [{self.TABLE}] (
+                    key VARCHAR(255) PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                );
+            """)
+            conn.commit()
+
+    def Take(self, key: str) -> Tuple[bool, float]:
+        """消耗一个令牌, 补充和扣减在同一条 UPSERT 中完成, 多进程并发时也不会超发"""
+        # 多个进程之间只能用墙上时间
+        now = time.time()
+        refill = "MIN(?, tokens + (? - updated) * ?)"
+        with self._open() as conn:
+            if now >= self._next_sweep:
+                idle = self.Burst / self.Rate if self.Rate > 0 else self.SweepInterval
+                conn.execute(f"DELETE FROM [{self.TABLE}] WHERE updated < ?", (now - idle,))
+                self._next_sweep = now + self.SweepInterval
+            cursor = conn.execute(f"""
+                INSERT INTO [{self.TABLE}] (key, tokens, updated) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET tokens = {refill} - 1, updated = excluded.updated
+                WHERE {refill} >= 1
+            """, (key, self.Burst - 1, now, self.Burst, now, self.Rate, self.Burst, now, self.Rate))
+            if cursor.rowcount:
+                conn.commit()
+                return True, 0.0
+            row = conn.execute(f"SELECT {refill} FROM [{self.TABLE}] WHERE key = ?",
+                               (self.Burst, now, self.Rate, key)).fetchone()
+            conn.commit()
+        tokens = row[0] if row else 0.0
+        return False, (1 - tokens) / self.Rate if self.Rate > 0 else self.SweepInterval
@@ -1,15 +1,25 @@
 import hashlib
+import hmac
 import os
 import binascii
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 class PasswordHelper:
+    """
+    密码哈希格式: 算法$迭代次数$盐$哈希, 参数随哈希一起保存, 调整迭代次数不会影响已有账户
+    旧版本只在 password_hash 中保存十六进制哈希, 盐在 salt 列, 固定 100000 次迭代, 仍然可以验证
+    """
+    ALGORITHM = "pbkdf2_sha256"
+    LEGACY_ITERATIONS = 100000
+
     @staticmethod
     def generate_salt():
         return binascii.hexlify(os.urandom(16)).decode('utf-8')
     
     @staticmethod
-    def hash_password(password: str, salt: str):
-        iterations = 100000
+    def hash_password(password: str, salt: str, iterations: int = LEGACY_ITERATIONS):
         key = hashlib.pbkdf2_hmac(
             'sha256',
             password.encode('utf-8'),
@@ -18,7 +28,125 @@ class PasswordHelper:
         )
         return binascii.hexlify(key).decode('utf-8')
     
+    @staticmethod
+    def encode_password(password: str, iterations: int) -> tuple:
+        """生成新格式的哈希, 返回 (哈希字符串, 盐)"""
+        salt = PasswordHelper.generate_salt()
+        key = PasswordHelper.hash_password(password, salt, iterations)
+        return f"{PasswordHelper.ALGORITHM}${iterations}${salt}${key}", salt
+
+    @staticmethod
+    def parse_hash(stored_hash: str, salt: str) -> tuple:
+        """解析为 (算法, 迭代次数, 盐, 哈希), 兼容旧格式"""
+        if "$" not in stored_hash:
+            return PasswordHelper.ALGORITHM, PasswordHelper.LEGACY_ITERATIONS, salt, stored_hash
+        algorithm, iterations, salt, key = stored_hash.split("$", 3)
+        return algorithm, int(iterations), salt, key
+
     @staticmethod
     def verify_password(password: str, salt: str, stored_hash: str):
-        new_hash = PasswordHelper.hash_password(password, salt)
-        return new_hash == stored_hash
+        algorithm, iterations, salt, key = PasswordHelper.parse_hash(stored_hash, salt)
+        if algorithm != PasswordHelper.ALGORITHM:
+            return False
+        new_hash = PasswordHelper.hash_password(password, salt, iterations)
+        # 固定时间比较, 避免通过响应时间推测哈希
+        return hmac.compare_digest(new_hash.encode('utf-8'), key.encode('utf-8'))
+
+    @staticmethod
+    def needs_rehash(stored_hash: str, iterations: int) -> bool:
+        """旧格式或参数与当前配置不一致时需要重新哈希"""
+        algorithm, current, _, _ = PasswordHelper.parse_hash(stored_hash, "")
+        return "$" not in stored_hash or algorithm != PasswordHelper.ALGORITHM or current != iterations
+
+    @staticmethod
+    def calibrate(target_ms: float = 250, sample_iterations: int = 20000) -> int:
+        """测量本机速度, 返回单次哈希耗时接近 target_ms 的迭代次数(取整到千)"""
+        best = None
+        for _ in range(3):
+            started = time.perf_counter()
+            PasswordHelper.hash_password("calibrate", PasswordHelper.generate_salt(), sample_iterations)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        iterations = int(sample_iterations * target_ms / 1000 / best)
+        return max(1000, round(iterations, -3))
+
+
+class HashPoolBusy(Exception):
+    """密码哈希队列已满"""
+
+
+class HashPool:
+    """
+    密码哈希专用线程池, pbkdf2_hmac 计算时会释放 GIL
+    调用 Run 的线程会一直等到哈希完成, 所以 max_pending 要小于 Web 线程数;
+    排队(含正在计算)的任务数达到 max_pending 时直接抛出 HashPoolBusy, 不再等待
+    """
+    def __init__(self, workers: int = 2, max_pending: int = 16):
+        self.Workers = max(1, workers)
+        self.MaxPending = max(1, max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=self.Workers, thread_name_prefix="PasswordHash")
+        self._lock = threading.Lock()
+        self._pending = 0
+
+        self.Completed = 0
+        self.Rejected = 0
+        self.QueueTime = 0.0
+        self.HashTime = 0.0
+        self.MaxLatency = 0.0
+
+    def _run(self, func, args, submitted: float):
+        started = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            finished = time.monotonic()
+            with self._lock:
+                self._pending -= 1
+                self.Completed += 1
+                self.QueueTime += started - submitted
+                self.HashTime += finished - started
+                self.MaxLatency = max(self.MaxLatency, finished - submitted)
+
+    def Run(self, func, *args):
+        """在池中执行 func(*args) 并等待结果"""
+        with self._lock:
+            if self._pending >= self.MaxPending:
+                self.Rejected += 1
+                raise HashPoolBusy(f"密码哈希队列已满({self.MaxPending})")
+            self._pending += 1
+        try:
+            future = self._executor.submit(self._run, func, args, time.monotonic())
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+            raise
+        return future.result()
+
+    def Hash(self, password: str, iterations: int) -> tuple:
+        """返回 (新格式的哈希字符串, 盐)"""
+        return self.Run(PasswordHelper.encode_password, password, iterations)
+
+    def Verify(self, password: str, salt: str, stored_hash: str) -> bool:
+        return self.Run(PasswordHelper.verify_password, password, salt, stored_hash)
+
+    def Stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.Workers,
+                "pending": self._pending,
+                "max_pending": self.MaxPending,
+                "completed": self.Completed,
+                "rejected": self.Rejected,
+                "avg_queue_time": self.QueueTime / self.Completed if self.Completed else 0.0,
+                "avg_hash_time": self.HashTime / self.Completed if self.Completed else 0.0,
+                "max_latency": self.MaxLatency,
+            }
+
+
+if __name__ == '__main__':
+    # 校准迭代次数: python -m util.security [目标耗时毫秒]
+    import sys
+    target = float(sys.argv[1]) if len(sys.argv) > 1 else 250
+    iterations = PasswordHelper.calibrate(target)
+    print(f"目标耗时 {target:g}ms, 建议在 config.yaml 中设置:")
+    print(f"PasswordIterations: {iterations}")
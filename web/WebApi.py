@@ -1,23 +1,32 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response
 from flask_jwt_extended import (
     JWTManager, jwt_required, create_access_token,
-    get_jwt_identity, get_jwt
+    get_jwt_identity, get_jwt, decode_token
 )
 import os
+import queue
+import time
 from functools import wraps
 from script.UserManageAPI import (sql,
     BanUser, ChangeName, CreateUserData, DeBan,
-    DeOP, GetBanInfo, GetUserInfo, GiveOP,
-    InsertAvatar, ReGetKey, RemoveUser,
+    DeOP, FindAvatar, GetActiveBans, GetAvatarJob, GetBanInfo, GetUserInfo, GiveOP,
+    ListUsers, ReadAvatar, ReGetKey, RemoveUser, SubmitAvatar,
     is_CheckAdmin, is_CheckSuperAdmin
 )
 from script.NetApiFormat import *
 from datetime import timedelta
 from script.WebUserManage import UpdateUserPassword, VerifyUserPassword
+from util.security import HashPoolBusy
+from util.ratelimit import SqliteTokenBucketLimiter, TokenBucketLimiter
+from util.log import _log
+from script.StreamHub import StreamHub
+from script.StatusHistory import StatusHistory
 from util.YamlRead import (
     CelesteNetWebRedirect, 
-    UserDataPath, WebTitle,
-    JWT_SECRET_KEY, JWT_ACCESS_TOKEN_EXPIRES_MINUTES
+    UserDataPath, WebTitle, AvatarMaxBytes,
+    JWT_SECRET_KEY, JWT_ACCESS_TOKEN_EXPIRES_MINUTES,
+    LoginIPRate, LoginIPBurst, LoginUidRate, LoginUidBurst, LoginRateShared,
+    ServerStatusInterval, StreamMaxClients, StreamLifetime, StatusHistorySize
 )
 
 app = Flask(__name__, template_folder='html')
@@ -27,6 +36,36 @@ app.config['JWT_SECRET_KEY'] = JWT_SECRET_KEY
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(minutes=JWT_ACCESS_TOKEN_EXPIRES_MINUTES)
 jwt = JWTManager(app)
 
+# 登录限流, 每次尝试同时消耗 IP 和用户名两个令牌桶, 在计算密码哈希之前拦截
+def _LoginLimiter(per_minute: float, burst: float):
+    if per_minute <= 0:
+        return None
+    if LoginRateShared:
+        return SqliteTokenBucketLimiter(sql.Open, per_minute / 60, burst)
+    return TokenBucketLimiter(per_minute / 60, burst)
+
+login_limiters = [
+    (limiter, prefix) for limiter, prefix in (
+        (_LoginLimiter(LoginIPRate, LoginIPBurst), "ip"),
+        (_LoginLimiter(LoginUidRate, LoginUidBurst), "uid"),
+    ) if limiter is not None
+]
+
+def _LoginThrottled(uid: str) -> float:
+    """返回需要等待的秒数, 0 表示允许登录"""
+    wait = 0.0
+    keys = {"ip": request.remote_addr or "", "uid": uid}
+    for limiter, prefix in login_limiters:
+        allowed, retry_after = limiter.Take(f"{prefix}:{keys[prefix]}")
+        if not allowed:
+            wait = max(wait, retry_after)
+    return wait
+
+# 密码哈希排队已满时快速拒绝, 不占用 Web 线程等待
+@app.errorhandler(HashPoolBusy)
+def hash_pool_busy(e):
+    return jsonify({"status": "error", "message": "服务器繁忙, 请稍后再试"}), 503, {"Retry-After": "1"}
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -66,6 +105,11 @@ def login():
     
     if not uid or not pwd:
         return jsonify({"status": "error", "message": "用户名密码的格式不正确"}), 400
+    wait = _LoginThrottled(uid)
+    if wait:
+        _log._WARN(f"[login]x {request.remote_addr} 登录 {uid} 过于频繁")
+        return jsonify({"status": "error", "message": "登录尝试过于频繁, 请稍后再试"}), 429, \
+            {"Retry-After": str(max(1, int(wait + 0.999)))}
     # 验证用户凭证
     user_info = GetUserInfo(uid)
     if not user_info:
@@ -417,6 +461,66 @@ def get_ban_info():
     info["Admin"] = user["Admin"]
     return jsonify({"status": "success", "data": info})
 
+# 查询当前生效的封禁列表
+@app.route('/api/bans', methods=['GET'])
+@admin_required
+def get_active_bans():
+    """
+    输入类型:
+    limit       每页数量(可选), 默认50, 最大200
+    after       上一页最后一个用户名(可选), 不填则从第一页开始
+
+    按用户名排序分页返回当前生效的封禁
+    [
+    {"UID": "Example1", "Reason": "封禁例子", "StartTime": "2025-05-01 12:00:00", "EndTime": "永久封禁"}
+    ]
+
+    返回字段:
+    data        本页封禁列表
+    next        下一页的after参数, 没有下一页时为None
+    """
+    limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+    after = request.args.get('after')
+    info = GetActiveBans(limit, after)
+    next_after = info[-1]["UID"] if len(info) == limit else None
+    return jsonify({"status": "success", "data": info, "next": next_after})
+
+def _BoolArg(name: str):
+    value = request.args.get(name)
+    if value is None or value == "":
+        return None
+    return value.lower() in ("1", "true", "yes")
+
+# 用户目录
+@app.route('/api/users', methods=['GET'])
+@admin_required
+def list_users():
+    """
+    输入类型:
+    limit       每页数量(可选), 默认50, 最大200
+    after       上一页返回的next(可选), 不填则从第一页开始
+    q           用户名或邮箱前缀(可选)
+    admin       只看管理员(true)或非管理员(false)(可选)
+    banned      只看封禁中(true)或未封禁(false)的用户(可选)
+
+    按注册顺序分页返回用户
+    [
+    {"iid": 1, "uid": "Example1", "name": "Example1", "Avatar": false, "Admin": false, "SuperAdmin": false, "Email": None, "Banned": false}
+    ]
+
+    返回字段:
+    data        本页用户列表, 不包含密钥
+    next        下一页的after参数, 没有下一页时为None
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+        after = int(request.args.get('after') or 0)
+    except ValueError:
+        return jsonify({"status": "error", "message": "参数格式不正确"}), 400
+    users, next_after = ListUsers(limit, after, request.args.get('q') or None,
+                                  _BoolArg('admin'), _BoolArg('banned'))
+    return jsonify({"status": "success", "data": users, "next": next_after})
+
 # 获取服务器信息
 @app.route('/api/server', methods=['GET'])
 def get_server_info():
@@ -441,9 +545,87 @@ def get_server_info():
     Banned          被Ban玩家的数量
     Registered      总共注册的用户数量
     TickRate        服务器最近的平均Tick, 如果是满Tick则为60.0
+    updated         最后一次成功获取状态的时间戳, 从未成功时为None
+    stale           最近一次刷新失败或数据已经过期
+
+    数据由后台线程定时刷新, 接口只读取内存中的快照, 不会请求上游
     """
-    info = ServerData()
-    return jsonify({"status": "success", "data": info})
+    snapshot = server_status.Get()
+    return jsonify({"status": "success", **snapshot})
+
+# 服务器状态历史, 每次刷新状态时记录
+status_history = StatusHistory(sql.Open, StatusHistorySize)
+server_status.Listeners.append(status_history.Record)
+
+@app.route('/api/server/history', methods=['GET'])
+def get_server_history():
+    """
+    输入类型:
+    range       时间范围, 例如 30m / 6h / 7d, 默认1h
+
+    按列返回服务器状态历史, 范围较小时为原始采样, 较大时为分钟或小时汇总
+    {
+        "resolution": "1m",
+        "data": {"Time": [1700000000], "PlayerRefs": [3.5], "PlayerRefsMax": [4], "TickRate": [59.8], "TickRateMin": [55.0]}
+    }
+
+    返回字段:
+    resolution  raw 原始采样 / 1m 分钟汇总 / 1h 小时汇总
+    Time        采样时间或汇总区间开始的时间戳
+    PlayerRefs  在线用户数量, 汇总数据为平均值
+    TickRate    服务器Tick, 汇总数据为平均值
+    PlayerRefsMax / TickRateMin 只在汇总数据中出现, 区间内的最大在线数和最低Tick
+    """
+    seconds = StatusHistory.ParseRange(request.args.get('range', '1h'))
+    if seconds is None or seconds > StatusHistory.HOUR_RETENTION:
+        return jsonify({"status": "error", "message": "range 格式不正确"}), 400
+    return jsonify({"status": "success", **status_history.Query(seconds)})
+
+# 服务器状态和玩家列表的推送, 所有连接共用一次上游轮询
+stream_hub = StreamHub(server_status, CachedPlayerList, ServerStatusInterval, StreamMaxClients)
+
+@app.route('/api/stream', methods=['GET'])
+def status_stream():
+    """
+    输入类型:
+    token       登录后的access_token(可选), EventSource 无法携带请求头, 所以放在参数中
+
+    Server-Sent Events 推送, 内容变化时才会推送:
+    event: status   与 /api/server 的返回相同
+    event: players  登录后才会收到, 第一次为 {"full": [...]}, 之后为 {"added": [...], "removed": ["昵称"]}
+
+    连接数达到上限时返回503, 前端退回普通请求; 连接保持 StreamLifetime 秒后断开, 浏览器会自动重连
+    """
+    key = None
+    token = request.args.get('token')
+    if token:
+        try:
+            key = sql.GetKey(decode_token(token)["sub"]) or None
+        except Exception:
+            key = None
+    sub = stream_hub.Subscribe(key)
+    if sub is None:
+        return jsonify({"status": "error", "message": "推送连接数已满"}), 503
+
+    def generate():
+        try:
+            yield "retry: 5000\n\n"
+            deadline = time.monotonic() + StreamLifetime
+            while time.monotonic() < deadline:
+                try:
+                    message = sub.Queue.get(timeout=15)
+                except queue.Empty:
+                    # 心跳, 同时用于发现已经断开的连接
+                    yield ": ping\n\n"
+                    continue
+                if message is None:
+                    break
+                yield message
+        finally:
+            stream_hub.Unsubscribe(sub)
+
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # 获取在线玩家列表
 @app.route('/api/players', methods=['GET'])
@@ -462,22 +644,45 @@ def get_players_list():
     返回字段:
     Name    用户的昵称
     Avatar  返回的Api可以直接获得用户头像的缩略图
+
+    列表会缓存几秒, 同时到达的请求只会请求一次上游, 当前用户的key只用于上游鉴权
     """
     current_uid = get_jwt_identity()
-    key = sql.GetKey(current_uid)
-    info = PlayerList(key)
-    result_info = []
-    if info:
-        for i in info:
-            i_dict = {
-                "Name": i["Name"], 
-                "Avatar": "/api/avatar?uid=Guest"
-                }
-            if "Avatar" in i:
-                i_dict["Avatar"] = i["Avatar"]
-            result_info.append(i_dict)
+    result_info = CachedPlayerList(sql.GetKey(current_uid)) or []
     return jsonify({"status": "success", "data": result_info})
 
+# 获取头像
+@app.route('/api/avatar', methods=['GET'])
+def get_avatar():
+    """
+    输入类型:
+    uid         用户名, 没有头像时返回Guest的头像
+    size        头像边长(可选), 支持32/64/128, 默认64
+    v           版本号(可选), 带上时浏览器会长期缓存
+
+    直接从数据库的文件表读取头像
+    ETag为头像内容的sha256, 浏览器带If-None-Match且未变化时直接返回304, 不读取头像内容
+    """
+    uid = request.args.get('uid') or "Guest"
+    try:
+        size = int(request.args.get('size', 64))
+    except ValueError:
+        size = 64
+    found = FindAvatar(uid, size)
+    if not found:
+        return jsonify({"status": "error", "message": "没有找到头像"}), 404
+    avatar_uid, name, etag = found
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": "public, max-age=31536000, immutable" if request.args.get('v') else "public, max-age=60"
+    }
+    if etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+    data = ReadAvatar(avatar_uid, name)
+    if data is None:
+        return jsonify({"status": "error", "message": "没有找到头像"}), 404
+    return Response(data, mimetype="image/png", headers=headers)
+
 # 头像修改
 @app.route('/api/user/<uid>/upload_avatar', methods=['POST'])
 @jwt_required()
@@ -487,17 +692,22 @@ def upload_avatar(uid):
     <uid>       在链接中插入: 用户名
     file        上传的头像文件(图片)
 
-    用户上传头像文件，会自动保存到GlobalAvatar目录并转换为png格式
-    然后调用InsertAvatar函数更新用户头像
+    用户上传头像文件，会自动保存到GlobalAvatar目录
+    缩放和转换png在后台进程中完成, 接口只负责接收文件并返回任务id
+    前端通过 /api/user/<uid>/avatar_job/<job> 轮询处理结果
     
     返回字段:
-    success     上传成功
+    success     上传成功, 开始处理
     error       上传失败
+    job         头像处理任务id
     message     失败原因
     """
     current_uid = get_jwt_identity()
     if uid != current_uid:
         return jsonify({"status": "error", "message": "无权修改该用户的头像"}), 403
+
+    if request.content_length and request.content_length > AvatarMaxBytes + 64 * 1024:
+        return jsonify({"status": "error", "message": "头像文件过大"}), 413
     
     if 'file' not in request.files:
         return jsonify({"status": "error", "message": "未上传文件"}), 400
@@ -515,11 +725,33 @@ def upload_avatar(uid):
         filename = f"{uid}.png"
         filepath = os.path.join(f"{UserDataPath}/GlobalAvatar", filename)
         file.save(filepath)
-
-        if InsertAvatar(uid):
-            return jsonify({"status": "success"})
-        else:
-            return jsonify({"status": "error", "message": "更新头像失败"}), 500
+        if os.path.getsize(filepath) > AvatarMaxBytes:
+            os.remove(filepath)
+            return jsonify({"status": "error", "message": "头像文件过大"}), 413
+
+        job_id = SubmitAvatar(uid)
+        if not job_id:
+            return jsonify({"status": "error", "message": "头像处理繁忙, 请稍后再试"}), 503
+        return jsonify({"status": "success", "job": job_id}), 202
             
     except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
\ No newline at end of file
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# 查询头像处理进度
+@app.route('/api/user/<uid>/avatar_job/<job_id>', methods=['GET'])
+@jwt_required()
+def avatar_job(uid, job_id):
+    """
+    输入类型:
+    <uid>       在链接中插入: 用户名
+    <job_id>    上传头像时返回的任务id
+
+    返回字段:
+    state       pending 处理中, done 处理完成, error 处理失败
+    message     失败原因
+    """
+    current_uid = get_jwt_identity()
+    job = GetAvatarJob(job_id)
+    if uid != current_uid or not job or job["uid"] != uid:
+        return jsonify({"status": "error", "message": "没有找到该任务"}), 404
+    return jsonify({"status": "success", "data": {"state": job["state"], "message": job["message"]}})